@@ -7,8 +7,6 @@ import logging
 
 from OCRAutoModerator.bot import BotClient, logger
 
-client = BotClient()
-
 logging_level_mapping = {
     'info': logging.INFO,
     'debug': logging.DEBUG,
@@ -39,5 +37,6 @@ if args.level:
     logger.info(f"Set logging level to {logging_level_mapping[args.level]}")
 
 if args.run:
+    client = BotClient()
     asyncio.run(client.load_data())
     client.run()
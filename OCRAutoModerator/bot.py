@@ -8,15 +8,17 @@ import asyncio
 import logging
 # import signal
 import sys
+import time
 import traceback
-from OCRAutoModerator.image_reader import ImageReaderTesseract
+from OCRAutoModerator.image_reader import OCRExecutor
 import praw
 from OCRAutoModerator.managers.wiki_manager import WikiParser
 from OCRAutoModerator.config.config import *
 from OCRAutoModerator.managers.db_manager import get_viewed_submissions, insert_submission
 from OCRAutoModerator.managers.submission_manager import SubmissionManager
-from OCRAutoModerator.utils import fetch_media, is_video_or_gif
-from html import unescape
+from OCRAutoModerator.managers.pipeline_manager import PipelineManager
+from OCRAutoModerator.managers.cache_manager import OCRCache, AuthorCache
+from OCRAutoModerator.utils import time_phase, run_praw
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -40,30 +42,67 @@ class BotClient:
     def __init__(self):
         """ Initializes variables and loads data from db """
         # signal.signal(signal.SIGINT, signal_handler)
-        self.reddit = praw.Reddit(
-            client_id=reddit_id,
-            client_secret=reddit_secret,
-            password=reddit_pass,
-            user_agent=reddit_agent,
-            username=reddit_name,
-            check_for_async=False)
+        self.startup_start = time.perf_counter()
+        self.startup_timings = {}
+        # The OCR workers are forked first, before praw or anything else starts a thread, and load their models in the
+        # background while the configs and seen submissions load. See load_data.
+        with time_phase(self.startup_timings, 'ocr workers forked'):
+            self.ir = OCRExecutor(ocr_pool_size)
+            self.ir.warm_up()
+
+        with time_phase(self.startup_timings, 'praw'):
+            self.reddit = praw.Reddit(
+                client_id=reddit_id,
+                client_secret=reddit_secret,
+                password=reddit_pass,
+                user_agent=reddit_agent,
+                username=reddit_name,
+                check_for_async=False)
 
         self.wiki_configs = {}
         self.wiki_manager = WikiParser(self.reddit, self.wiki_configs)
-        self.ir = ImageReaderTesseract()
-        self.submission_manager = SubmissionManager(self.reddit, self.ir)
+        self.ocr_cache = OCRCache()
+        self.author_cache = AuthorCache()
+        self.submission_manager = SubmissionManager(self.reddit, self.ir, self.ocr_cache, self.author_cache)
+        self.pipeline_manager = PipelineManager(self.submission_manager)
         self.viewed_submissions = None
-        self.sub_list = self.reddit.redditor(reddit_name).moderated()
-        logger.info(f'Successfully loaded! {bot_name} is active...')
+        with time_phase(self.startup_timings, 'moderated subreddits'):
+            self.sub_list = self.reddit.redditor(reddit_name).moderated()
 
     async def load_data(self) -> None:
-        self.viewed_submissions = await get_viewed_submissions()
+        with time_phase(self.startup_timings, 'seen submissions'):
+            self.viewed_submissions = await get_viewed_submissions()
+
+        with time_phase(self.startup_timings, 'ocr cache'):
+            await self.ocr_cache.setup()
+            await self.ocr_cache.evict()
+
+        with time_phase(self.startup_timings, 'author cache'):
+            await self.author_cache.setup()
+            await self.author_cache.evict()
+
+        with time_phase(self.startup_timings, 'wiki configs'):
+            await self.load_wiki_configs()
+
+        # Load the easyocr Readers the configs use now, rather than on the first submission that needs them
+        lang_groups = {langs for config in self.wiki_configs.values() for langs in config.language_plan.easyocr}
+        self.ir.preload(sorted(lang_groups))
+
+        with time_phase(self.startup_timings, 'waiting on ocr models'):
+            await self.ir.wait_ready()
+
+        timings = ', '.join(f'{phase}: {seconds:.2f}s' for phase, seconds in self.startup_timings.items())
+        logger.info(f'Successfully loaded in {time.perf_counter() - self.startup_start:.2f}s ({timings})! '
+                    f'{bot_name} is active...')
+
+    async def load_wiki_configs(self) -> None:
         for subreddit in self.sub_list:
             try:
                 self.wiki_configs[subreddit.display_name.lower()] = await self.wiki_manager.load_wiki_config(subreddit)
             except:
                 traceback.print_exc()
-                self.wiki_configs[subreddit.display_name.lower()] = self.wiki_manager.parse(default_wiki)
+                self.wiki_configs[subreddit.display_name.lower()] = \
+                    self.wiki_manager.compile(self.wiki_manager.parse(default_wiki))
                 # Maybe worth mod mailing the sub? Then again, this only happens on restarts, and I would be notified instantly.
                 # However... the very fact it would happen means that mod team did not send the update msg to the bot. Possibly need educating.
                 # self.reddit.redditor(developers[0]).message(
@@ -83,16 +122,20 @@ class BotClient:
         """ Runs the bot
         This function is entirely blocking, so any calls to other functions must
         be made prior to calling this. """
+        self.pipeline_manager.start()
         while 1:
             try:
                 await self.handle_dms()
                 await self.do_submissions()
             except:
                 traceback.print_exc()
+            # Submissions are handed to the pipeline without waiting on them, so this is what paces the polling
+            await asyncio.sleep(poll_interval)
 
     async def handle_dms(self) -> None:
-        """ Looks for mod invites and checks for wiki updates and resets """
-        for msg in self.reddit.inbox.unread(mark_read=True):
+        """ Looks for mod invites and checks for wiki updates and resets.
+        praw is blocking, so its calls are made in the praw thread to keep the pipeline moving, see run_praw. """
+        for msg in await run_praw(list, self.reddit.inbox.unread(mark_read=True)):
             if not msg.was_comment and (msg.body.startswith('gadzooks!') and 'invitation to moderate' in msg.subject):
                 try:
                     await self.accept_invite(msg)
@@ -106,35 +149,38 @@ class BotClient:
                     in self.wiki_configs and (msg.subject.lower() == 'update' or msg.subject.lower() == 'reset'):
                 await self.wiki_manager.on_wiki_update_request(msg)
 
-            msg.mark_read()
+            await run_praw(msg.mark_read)
 
     async def accept_invite(self, msg) -> None:
         """Accepts an invitation to a new subreddit, adds it to the database and creates a config wiki if none exists """
-        msg.subreddit.mod.accept_invite()
-        self.sub_list = self.reddit.redditor(reddit_name).moderated()
+        await run_praw(msg.subreddit.mod.accept_invite)
+        self.sub_list = await run_praw(self.reddit.redditor(reddit_name).moderated)
         await self.wiki_manager.on_subreddit_join(msg)
         logger.info(f"Accepted mod invite to r/{msg.subreddit.display_name}")
 
         redditor = self.reddit.redditor(developers[0])
-        redditor.message(
+        await run_praw(
+            redditor.message,
             f'{bot_name} was added to a new subreddit!',
             f'/r/{msg.subreddit.display_name} '
         )
 
     async def on_mod_removal(self, msg) -> None:
-        self.sub_list = self.reddit.redditor(reddit_name).moderated()
+        self.sub_list = await run_praw(self.reddit.redditor(reddit_name).moderated)
         logger.info(f"Removed from r/{msg.subreddit.display_name}")
 
         redditor = self.reddit.redditor(developers[0])
-        redditor.message(
+        await run_praw(
+            redditor.message,
             f'{bot_name} was removed from a subreddit!',
             f'/r/{msg.subreddit.display_name} '
         )
 
     async def do_submissions(self) -> None:
-        for submission in self.reddit.subreddit('mod' if not test_mode else 'Approval_Bot').new():
+        """ Feeds new submissions into the pipeline, which does the fetching, OCR and actioning concurrently """
+        listing = self.reddit.subreddit('mod' if not test_mode else 'Approval_Bot').new()
+        for submission in await run_praw(list, listing):
             subreddit = submission.subreddit
-            media_url = submission.url_overridden_by_dest if hasattr(submission, 'url_overridden_by_dest') else None
             if submission.id in self.viewed_submissions:
                 #  or \
                 #                     (not hasattr(submission, 'url_overridden_by_dest') and not hasattr(submission, 'media_metadata'))
@@ -149,42 +195,10 @@ class BotClient:
                 continue
 
             logger.info(f'Scanning {submission.id} by /u/{submission.author} on /r/{subreddit.display_name}')
-            try:
-                # If the content is an image
-                if media := fetch_media(media_url) or hasattr(submission, 'media_metadata'):
-                    if media:
-                        match_sets = \
-                            await self.submission_manager.check_image(
-                                submission, media, self.wiki_configs[subreddit.display_name.lower()]
-                            )
-                    else:
-                        media = set()
-                        metadata = submission.media_metadata
-                        # e = media type, s = the highest resolution link
-                        [
-                            media.add((unescape(metadata[key]['s']), metadata[key]['e']))
-                            for key in metadata if metadata[key]['status'] == 'valid'
-                        ]
-                        match_sets = await self.submission_manager.check_multi_media(
-                            submission, media, self.wiki_configs[subreddit.display_name.lower()])
-
-                elif is_video_or_gif(submission):
-                    match_sets = self.submission_manager.check_video(
-                        submission, self.wiki_configs[subreddit.display_name.lower()]
-                    )
-
-                else:
-                    match_sets = await self.submission_manager.check_text(
-                        submission,
-                        self.wiki_configs[subreddit.display_name.lower()])
-
-                await self.submission_manager.do_submission(submission, match_sets)
-                logger.info(
-                    f'Scanning complete for {submission.id} by /u/{submission.author} on /r/{subreddit.display_name}')
-            except:
-                traceback.print_exc()
+            await self.pipeline_manager.put(submission, self.wiki_configs[subreddit.display_name.lower()])
 
 
-client = BotClient()
-asyncio.run(client.load_data())
-client.run()
+if __name__ == '__main__':
+    client = BotClient()
+    asyncio.run(client.load_data())
+    client.run()
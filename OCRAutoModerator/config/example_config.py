@@ -9,7 +9,16 @@ __all__ = [
     'reddit_agent', 'reddit_name', 'developers', 'bot_name', 'default_wiki',
     'wiki_permissions_error', 'join_success', 'test_wiki', 'acceptable_languages_easyocr',
     'acceptable_languages_pytesseract', 'universal_lang_codes', 'language_map_easyocr_to_pytes',
-    'language_map_pytes_to_easyocr', 'default_comment', 'test_mode'
+    'language_map_pytes_to_easyocr', 'default_comment', 'test_mode', 'pipeline_queue_size',
+    'pipeline_fetch_workers', 'pipeline_decode_workers', 'pipeline_ocr_workers', 'pipeline_rule_workers',
+    'pipeline_action_workers', 'poll_interval', 'ocr_pool_size', 'ocr_cache_max_entries', 'ocr_cache_max_age',
+    'media_hash_distance', 'media_thumbnail_tolerance', 'frame_dedup_tolerance', 'video_max_frames',
+    'video_min_frame_spacing', 'video_scene_checks_per_second', 'video_window',
+    'gif_frame_spacing', 'easyocr_language_scripts', 'easyocr_reader_budget', 'easyocr_batch_size',
+    'easyocr_batch_wait', 'ocr_backend', 'onnx_quantize', 'onnx_model_dir', 'tesseract_backend', 'tessdata_path',
+    'default_ocr_engine', 'cascade_min_confidence', 'ocr_grayscale', 'ocr_target_text_height', 'ocr_min_text_height',
+    'ocr_max_side', 'ocr_tile_size', 'ocr_tile_overlap', 'text_gate', 'text_gate_min_score', 'text_gate_audit_rate',
+    'author_cache_max_entries', 'author_cache_ttls', 'author_cache_default_ttl'
 ]
 
 # Bot related options
@@ -26,6 +35,73 @@ reddit_pass = ''  # password of the redditor the bot is run out of
 reddit_agent = 'script:OCRAutoModerator:v2.0.0 (by u/theimperious1)'  # the script's user agent
 reddit_name = 'OCRAutoModerator'  # username of the bot account
 
+# Submission pipeline options
+pipeline_queue_size = 32  # max submissions waiting between two stages before the previous stage blocks
+pipeline_fetch_workers = 8  # concurrent media downloads
+pipeline_decode_workers = 2  # concurrent video/gif frame extractions
+pipeline_ocr_workers = 2  # concurrent submissions being OCR'd. Each one spreads its frames across the OCR pool
+pipeline_rule_workers = 4  # concurrent rule checks
+pipeline_action_workers = 2  # concurrent removals/reports
+poll_interval = 10  # seconds between checks of the inbox and new submissions
+
+# OCR options
+ocr_pool_size = 0  # OCR worker processes, each holding its own models in memory. 0 = one per CPU core
+ocr_cache_max_entries = 200000  # OCR results kept for reposted media. Least recently used are evicted first
+ocr_cache_max_age = 30  # days before a cached OCR result is evicted
+author_cache_max_entries = 50000  # author facts, e.g karma, kept in memory. The rest are read back from the database
+author_cache_default_ttl = 60 * 60  # seconds an author fact missing from author_cache_ttls is cached for
+# seconds each author fact is cached for, shared by every rule and every submission by that author
+author_cache_ttls = {
+    'created_utc': 60 * 60 * 24 * 30,
+    'link_karma': 60 * 60,
+    'comment_karma': 60 * 60,
+    'has_verified_email': 60 * 60 * 24,
+    'is_mod': 60 * 60 * 24,
+    'is_gold': 60 * 60 * 24,
+    'is_suspended': 60 * 60,
+    'profile_over_18': 60 * 60 * 24,
+    'followers': 60 * 60 * 24,
+    'description': 60 * 60 * 24,
+    'trophies': 60 * 60 * 24,
+    'mod_notes': 60 * 10,
+    'comments': 60 * 60,
+    'submissions': 60 * 60,
+    'links': 60 * 10,
+}
+media_hash_distance = 4  # max differing dhash bits (out of 64) for media to be compared as a repost of cached media
+media_thumbnail_tolerance = 16  # max greyscale difference (0-255) of any thumbnail pixel for a repost to be trusted
+frame_dedup_tolerance = 12  # video/gif frames whose 32x32 greyscale thumbnail is within this of the last read frame's
+#                             in every pixel (0-255) aren't taken or OCR'd. Kept low, so a changed caption is read
+easyocr_reader_budget = 4096  # MB of easyocr models all OCR workers keep loaded, split evenly between them. A worker
+#                               over its share drops its least recently used Reader, but always keeps the newest one
+easyocr_batch_size = 8  # max same-sized images/frames easyocr reads in one batch
+easyocr_batch_wait = 0.05  # max seconds an image waits for others to batch with before it's read anyway
+ocr_backend = 'torch'  # runs easyocr's models with 'torch', or 'onnx' for ONNX Runtime (needs the onnx and onnxruntime packages)
+onnx_quantize = True  # int8 quantizes the onnx models' LSTM and linear layers
+onnx_model_dir = 'onnx_models/'  # where easyocr's models are exported to the first time the onnx backend loads them
+tesseract_backend = 'tesserocr'  # 'tesserocr' keeps tesseract loaded in each OCR worker, 'pytesseract' runs it per image
+tessdata_path = ''  # tesserocr's traineddata directory, '' for the one tesseract was built with
+default_ocr_engine = 'fast'  # engine for rules that don't set one: 'fast', 'thorough' or 'both', see default_wiki
+cascade_min_confidence = 0.8  # 'fast' reads with easyocr as well when tesseract's mean confidence is below this
+
+# OCR preprocessing options, see preprocessing.preprocess
+ocr_grayscale = True  # images and frames are OCR'd in greyscale
+ocr_target_text_height = 32  # px tall images' text is scaled down to
+ocr_min_text_height = 12  # px an image's smallest text, e.g a watermark, is never scaled below
+ocr_max_side = 2048  # px images with no measurable text are scaled down to
+ocr_tile_size = 1280  # px wide and tall tiles that larger images are cut into
+ocr_tile_overlap = 160  # px tiles overlap by, should be more than a line of text
+text_gate = True  # images and frames that don't look like they contain text aren't OCR'd
+text_gate_min_score = 2  # letter shaped blobs lined up like words an image needs to be OCR'd, see get_text_score
+text_gate_audit_rate = 0.05  # share of gated images OCR'd anyway, to measure how much text the gate misses
+
+# Video frame sampling options
+video_window = 59  # seconds from the start of a video that are scanned
+video_max_frames = 59  # most frames taken from a single video
+video_min_frame_spacing = 0.5  # seconds between two frames taken from a video
+video_scene_checks_per_second = 4  # how often frames are compared with the last taken frame to look for changes
+gif_frame_spacing = 1.0  # seconds between frames taken from a gif
+
 
 # Default removal comment
 default_comment = 'Sorry, your submission appears to violate our rules and has been removed.'
@@ -39,6 +115,9 @@ default_wiki = '''
 # Priority is required to be unique. Rules will be sorted by priority, and actioned by priority.
 # If one rule triggers for a removal, the rest will be ignored.
 # If both a removal and report rule are both triggered, removal will take priority. 
+# Videos stop being read as soon as a remove or spam rule matches. Add stop_on_match: false to a rule to read them fully.
+# engine picks how hard images are read for a rule. fast (default) reads with tesseract, and with easyocr as well only
+# when tesseract finds no text or isn't sure of it. thorough always reads with easyocr. both always reads with both.
 # Rule items can be a word, sentence, phrase, whatever. Any text is valid.
 # If using backslashes e.g \\, make sure to escape it by adding an extra. \\\\.
 ---
@@ -123,6 +202,9 @@ test_wiki = '''
 # Priority is required to be unique. Rules will be sorted by priority, and actioned by priority.
 # If one rule triggers for a removal, the rest will be ignored.
 # If both a removal and report rule are both triggered, removal will take priority. 
+# Videos stop being read as soon as a remove or spam rule matches. Add stop_on_match: false to a rule to read them fully.
+# engine picks how hard images are read for a rule. fast (default) reads with tesseract, and with easyocr as well only
+# when tesseract finds no text or isn't sure of it. thorough always reads with easyocr. both always reads with both.
 # Rule items can be a word, sentence, phrase, whatever. Any text is valid.
 # If using backslashes e.g \\, make sure to escape it by adding an extra. \\\\.
 ---
@@ -607,3 +689,22 @@ language_map_pytes_to_easyocr = {
     "uzb": "uz",
     "vie": "vi"
 }
+
+# easyocr can only load languages sharing a recognition model into one Reader, plus English which fits with any of them.
+# Languages not listed here use the latin model.
+easyocr_language_scripts = {
+    **dict.fromkeys(('ar', 'fa', 'ug', 'ur'), 'arabic'),
+    **dict.fromkeys(('bn', 'as', 'mni'), 'bengali'),
+    **dict.fromkeys(('ru', 'rs_cyrillic', 'be', 'bg', 'uk', 'mn', 'abq', 'ady', 'kbd', 'ava', 'dar', 'inh', 'che', 'lbe',
+                     'lez', 'tab', 'tjk'), 'cyrillic'),
+    **dict.fromkeys(('hi', 'mr', 'ne', 'bh', 'mai', 'ang', 'bho', 'mah', 'sck', 'new', 'gom', 'sa', 'bgc'),
+                    'devanagari'),
+    'th': 'thai',
+    'ch_sim': 'chinese_sim',
+    'ch_tra': 'chinese_tra',
+    'ja': 'japanese',
+    'ko': 'korean',
+    'ta': 'tamil',
+    'te': 'telugu',
+    'kn': 'kannada',
+}
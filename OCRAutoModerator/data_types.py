@@ -6,3 +6,6 @@ ActionData = namedtuple('ActionData', 'item action action_reason priority')
 ActionData2 = namedtuple('ActionData2', 'item action action_reason priority')
 MatchSets = namedtuple('MatchSets', 'remove spam approve report')
 ActionableItem = namedtuple('ActionableItem', 'action_data submission rule_set')
+LanguagePlan = namedtuple('LanguagePlan', 'easyocr pytesseract')
+MediaHash = namedtuple('MediaHash', 'sha dhash shape thumbnail')
+PipelineJob = namedtuple('PipelineJob', 'submission config rules facts content_type media text match_sets')
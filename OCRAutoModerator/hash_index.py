@@ -0,0 +1,151 @@
+""" OCRAutoModerator near-duplicate media index
+@authors:
+---
+https://github.com/theimperious1
+https://www.reddit.com/user/theimperious1
+"""
+
+import logging
+import time
+from itertools import combinations
+import aiosqlite
+import numpy as np
+from differencer import hamming_distance
+from OCRAutoModerator.config.config import db_path
+
+logger = logging.getLogger(__name__)
+
+# The 64-bit hashes are split into this many 16-bit chunks, each with its own sorted table
+CHUNKS = 4
+CHUNK_BITS = 16
+# Inserts are scanned linearly until there are this many, then merged into the sorted tables
+MERGE_THRESHOLD = 4096
+
+
+def to_signed_64(value: int) -> int:
+    """ SQLite integers are signed 64-bit, so hashes with the top bit set must wrap """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def chunk_probes(chunk: int, radius: int) -> np.ndarray:
+    """ Every 16-bit value within radius bits of chunk """
+    probes = [chunk]
+    for distance in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), distance):
+            flipped = chunk
+            for bit in bits:
+                flipped ^= 1 << bit
+            probes.append(flipped)
+    return np.array(probes, dtype=np.uint16)
+
+
+class HashIndex:
+    """
+    Multi-index hashing over 64-bit perceptual hashes.
+    If two hashes are within k bits of each other, at least one of their four 16-bit chunks is within k // 4 bits,
+    so a query only has to look at the few entries sharing a nearby chunk instead of every hash we've ever seen.
+    Candidates are then checked against the full hash. Ids are the rowids of the media_hashes table.
+    """
+
+    def __init__(self):
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.sorted_chunks = [np.empty(0, dtype=np.uint16) for _ in range(CHUNKS)]
+        self.orders = [np.empty(0, dtype=np.int64) for _ in range(CHUNKS)]
+        self.pending_hashes = []
+        self.pending_ids = []
+
+    def __len__(self) -> int:
+        return len(self.hashes) + len(self.pending_hashes)
+
+    def add(self, media_hash: int, media_id: int) -> None:
+        self.pending_hashes.append(media_hash)
+        self.pending_ids.append(media_id)
+        if len(self.pending_hashes) >= MERGE_THRESHOLD:
+            self.merge()
+
+    def merge(self) -> None:
+        """ Moves pending inserts into the sorted chunk tables """
+        if self.pending_hashes:
+            self.hashes = np.concatenate((self.hashes, np.array(self.pending_hashes, dtype=np.uint64)))
+            self.ids = np.concatenate((self.ids, np.array(self.pending_ids, dtype=np.int64)))
+            self.pending_hashes = []
+            self.pending_ids = []
+
+        for i in range(CHUNKS):
+            chunks = self.chunk(self.hashes, i)
+            self.orders[i] = np.argsort(chunks, kind='stable')
+            self.sorted_chunks[i] = chunks[self.orders[i]]
+
+    @staticmethod
+    def chunk(hashes: np.ndarray, i: int) -> np.ndarray:
+        return ((hashes >> np.uint64(i * CHUNK_BITS)) & np.uint64(0xFFFF)).astype(np.uint16)
+
+    def query(self, media_hash: int, max_distance: int) -> list[tuple]:
+        """ Returns (id, distance) for every indexed hash within max_distance bits, closest first """
+        radius = max_distance // CHUNKS
+        candidates = []
+        for i in range(CHUNKS):
+            probes = chunk_probes((media_hash >> (i * CHUNK_BITS)) & 0xFFFF, radius)
+            starts = np.searchsorted(self.sorted_chunks[i], probes, side='left')
+            ends = np.searchsorted(self.sorted_chunks[i], probes, side='right')
+            for start, end in zip(starts, ends):
+                if start != end:
+                    candidates.append(self.orders[i][start:end])
+
+        results = []
+        if candidates:
+            positions = np.unique(np.concatenate(candidates))
+            distances = hamming_distance(self.hashes[positions], media_hash)
+            close = distances <= max_distance
+            results.extend(zip(self.ids[positions][close].tolist(), distances[close].tolist()))
+
+        for pending_hash, pending_id in zip(self.pending_hashes, self.pending_ids):
+            distance = (pending_hash ^ media_hash).bit_count()
+            if distance <= max_distance:
+                results.append((pending_id, distance))
+
+        return sorted(results, key=lambda result: result[1])
+
+    @staticmethod
+    async def setup() -> None:
+        async with aiosqlite.connect(db_path) as db:
+            await db.execute(
+                "CREATE TABLE IF NOT EXISTS media_hashes (sha256 TEXT PRIMARY KEY, dhash INTEGER NOT NULL, "
+                "created INTEGER NOT NULL, shape TEXT, thumbnail BLOB)")
+            # Tables made before shapes and thumbnails were stored. Their rows only ever match exactly.
+            rows = await db.execute("PRAGMA table_info(media_hashes)")
+            async with rows as cursor:
+                columns = {row[1] for row in await cursor.fetchall()}
+            for column, column_type in (('shape', 'TEXT'), ('thumbnail', 'BLOB')):
+                if column not in columns:
+                    await db.execute(f"ALTER TABLE media_hashes ADD COLUMN {column} {column_type}")
+            await db.commit()
+
+    async def load(self) -> None:
+        """ Rebuilds the index from every hash stored in the database """
+        start = time.perf_counter()
+        async with aiosqlite.connect(db_path) as db:
+            rows = await db.execute("SELECT rowid, dhash FROM media_hashes")
+            async with rows as cursor:
+                results = await cursor.fetchall()
+
+        if results:
+            ids, hashes = zip(*results)
+            self.ids = np.array(ids, dtype=np.int64)
+            # SQLite integers are signed, see to_signed_64
+            self.hashes = np.array(hashes, dtype=np.int64).view(np.uint64)
+        self.pending_hashes = []
+        self.pending_ids = []
+        self.merge()
+        logger.info(f'Loaded {len(self.hashes)} media hashes in {time.perf_counter() - start:.2f}s')
+
+    async def insert(self, sha: str, media_hash: int, shape: str = None, thumbnail: bytes = None) -> None:
+        """ Stores a hash the first time its media is seen and adds it to the index """
+        async with aiosqlite.connect(db_path) as db:
+            cursor = await db.execute(
+                "INSERT OR IGNORE INTO media_hashes (sha256, dhash, created, shape, thumbnail) VALUES (?, ?, ?, ?, ?)",
+                (sha, to_signed_64(media_hash), int(time.time()), shape, thumbnail))
+            await db.commit()
+            if cursor.rowcount > 0:
+                self.add(media_hash, cursor.lastrowid)
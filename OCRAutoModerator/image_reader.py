@@ -5,42 +5,179 @@ https://github.com/theimperious1
 https://www.reddit.com/user/theimperious1
 """
 
+import asyncio
 import logging
-from pytesseract import pytesseract
-import easyocr
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Union
+import numpy as np
+from OCRAutoModerator.config.config import easyocr_reader_budget, easyocr_batch_size, easyocr_batch_wait, ocr_backend, \
+    tesseract_backend, tessdata_path
 
+# easyocr (and torch with it) and pytesseract are imported by the OCR worker processes when they first need them.
+# The bot process itself never loads a model, so it starts without paying for those imports.
 # from paddleocr import PaddleOCR
 
 logger = logging.getLogger(__name__)
-pytesseract.tesseract_cmd = r'/usr/bin/tesseract'
+TESSERACT_CMD = r'/usr/bin/tesseract'
 
+# Every OCR engine read_engines can run
+ENGINES = ('easyocr', 'pytesseract')
+# Seconds a worker waits at the barrier for the rest of the pool, e.g while they download models, see OCRExecutor.preload
+BARRIER_TIMEOUT = 30 * 60
 
-class ImageReaderTesseract:
+# The ImageReaderTesseract owned by an OCRExecutor worker process, and the barrier shared by the whole pool
+_worker_reader = None
+_worker_barrier = None
+
+
+class ReaderPool:
+    """
+    The easyocr Readers loaded in this process, keyed by language tuple, e.g ('de', 'en').
+    Every Reader holds a few hundred MB of model weights, so once they add up to more than budget MB the least recently
+    used are dropped. They're loaded again the next time they're needed.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget * 1024 * 1024
+        self.readers = OrderedDict()
+        self.sizes = {}
+        self.uses = {}
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, langs: tuple) -> bool:
+        return langs in self.readers
+
+    def get(self, langs: tuple) -> 'easyocr.Reader':
+        if langs in self.readers:
+            self.readers.move_to_end(langs)
+        else:
+            self.load(langs)
+
+        self.uses[langs] = self.uses.get(langs, 0) + 1
+        return self.readers[langs]
+
+    def load(self, langs: tuple) -> None:
+        import easyocr
+        if ocr_backend == 'onnx':
+            from OCRAutoModerator.onnx_backend import convert_reader
+            reader = convert_reader(easyocr.Reader(list(langs), quantize=False), langs)
+        else:
+            reader = easyocr.Reader(list(langs))
+        self.readers[langs] = reader
+        self.sizes[langs] = get_reader_size(reader)
+        self.loads += 1
+        logger.info(f'Loaded easyocr Reader {langs} ({self.sizes[langs] / 1024 / 1024:.0f}MB) in {os.getpid()}')
+        self.evict()
+
+    def evict(self) -> None:
+        # The newest Reader is never dropped, even if it alone is over budget
+        while len(self.readers) > 1 and sum(self.sizes.values()) > self.budget:
+            langs, _ = self.readers.popitem(last=False)
+            del self.sizes[langs]
+            self.evictions += 1
+            logger.info(f'Dropped easyocr Reader {langs} in {os.getpid()}. {self.stats()}')
+
+    def stats(self) -> str:
+        uses = ', '.join(f"{'+'.join(langs)}: {count}" for langs, count in self.uses.items())
+        return f'loaded: {list(self.readers)}, ' \
+               f'memory: {sum(self.sizes.values()) / 1024 / 1024:.0f}/{self.budget / 1024 / 1024:.0f}MB, ' \
+               f'loads: {self.loads}, evictions: {self.evictions}, uses: {{{uses}}}'
+
+
+def get_reader_size(reader: 'easyocr.Reader') -> int:
+    """ Bytes of model weights held by a Reader's detector and recognizer """
+    size = 0
+    for model in (getattr(reader, 'detector', None), getattr(reader, 'recognizer', None)):
+        if hasattr(model, 'model_bytes'):
+            # See onnx_backend.OnnxModel
+            size += model.model_bytes
+        elif model is not None and hasattr(model, 'parameters'):
+            size += sum(parameter.numel() * parameter.element_size() for parameter in model.parameters())
+    return size
+
+
+class TesseractAPIs:
+    """
+    Tesseract kept loaded in this process through its C API (tesserocr), one engine per language string, e.g 'deu+eng'.
+    Decoded images are handed over as raw pixel buffers, so reading one costs only the recognition itself, rather than
+    pytesseract writing it to a temp file and starting the tesseract command, which loads its traineddata again.
+    """
 
     def __init__(self):
-        # self.paddleocr = PaddleOCR(use_angle_cls=True, lang='en')
-        self.easyocr_readers = {'en': easyocr.Reader(['en'])}
+        import tesserocr
+        self.tesserocr = tesserocr
+        self.apis = {}
 
-    def read_all_methods(self, fp, media=None, lang_easyocr='en', lang_pytes='eng') -> list[tuple]:
-        # TODO: Get rid of duplicates from videos having dozens of identical frames for memes
+    def get(self, lang: str):
+        if lang not in self.apis:
+            if tessdata_path:
+                self.apis[lang] = self.tesserocr.PyTessBaseAPI(path=tessdata_path, lang=lang)
+            else:
+                self.apis[lang] = self.tesserocr.PyTessBaseAPI(lang=lang)
+            logger.info(f'Loaded tesseract {lang} in {os.getpid()}')
+        return self.apis[lang]
 
-        pytes_result = self.read_image_pytesseract(fp if not media else media, lang_pytes) if lang_pytes != 'INVALID' else []
+    def read(self, image, lang: str) -> tuple:
+        """ Returns the text and tesseract's mean word confidence in it, from 0 to 1 """
+        api = self.get(lang)
+        if isinstance(image, np.ndarray):
+            image = np.ascontiguousarray(image, dtype=np.uint8)
+            height, width = image.shape[:2]
+            channels = 1 if image.ndim == 2 else image.shape[2]
+            api.SetImageBytes(image.tobytes(), width, height, channels, width * channels)
+        else:
+            api.SetImage(image)
+        return api.GetUTF8Text(), api.MeanTextConf() / 100
+
+
+class ImageReaderTesseract:
+
+    def __init__(self, reader_budget: int = easyocr_reader_budget):
+        # self.paddleocr = PaddleOCR(use_angle_cls=True, lang='en')
+        # Readers are only loaded for the language groups that are used, see OCRExecutor.preload
+        self.easyocr_readers = ReaderPool(reader_budget)
+        self.tesseract = None
+        if tesseract_backend == 'tesserocr':
+            try:
+                self.tesseract = TesseractAPIs()
+            except ImportError:
+                logger.info('tesserocr is not installed, running tesseract through pytesseract instead')
+
+    def read_engines(self, fp, media=None, lang_easyocr='en', lang_pytes='eng', engines: tuple = ENGINES) -> dict:
+        """ Reads an image with each engine, keeping their results apart. e.g {'easyocr': [...], 'pytesseract': [...]}
+        engines limits which engines are run, e.g ('pytesseract',) """
+        engine_results = {}
+        if 'pytesseract' in engines:
+            pytes_result = self.read_image_pytesseract(fp if media is None else media, lang_pytes) if lang_pytes != 'INVALID' else ([], 'No Data')
+            engine_results['pytesseract'] = [pytes_result]
         # paddle_result = await self.read_image_paddleocr(fp)
-        easyocr_result = self.read_image_easyocr(fp, lang_easyocr) if lang_easyocr != 'INVALID' else []
+        if 'easyocr' in engines:
+            engine_results['easyocr'] = self.read_image_easyocr(fp, lang_easyocr) if lang_easyocr != 'INVALID' else []
 
-        # merged_result = paddle_result + easyocr_result
-        easyocr_result.append((pytes_result, 'No Data'))
-        return easyocr_result
+        return engine_results
 
-    @staticmethod
-    def read_image_pytesseract(fp, lang: str) -> str:
+    def read_image_pytesseract(self, fp, lang: str) -> tuple:
         """
         This method is pretty fast, but slower than easyocr. 10 seconds for 60 560kb frames.
         Made by Google and pretty good, but performs badly on small or large text in some cases.
+        Decoded images are read through TesseractAPIs when tesserocr is available. Paths and urls still go through
+        pytesseract.
 
         https://openbase.com/python/pytesseract
+        :return: Tuple of the text and its mean word confidence, 'No Data' when read through pytesseract.
         """
-        return pytesseract.image_to_string(fp, lang=lang)
+        if self.tesseract is not None and not isinstance(fp, str):
+            return self.tesseract.read(fp, lang)
+
+        from pytesseract import pytesseract
+        pytesseract.tesseract_cmd = TESSERACT_CMD
+        return pytesseract.image_to_string(fp, lang=lang), 'No Data'
 
     def read_image_paddleocr(self, fp) -> list:
         """
@@ -62,28 +199,221 @@ class ImageReaderTesseract:
 
         return results
 
-    def read_image_easyocr(self, fp, lang: str) -> list:
+    def read_image_easyocr(self, fp, lang: Union[str, tuple]) -> list:
         """
         This method is very fast. 5 seconds for 60 560kb frames.
         Good at small text and big text. Can find watermarks, copyright, onlyfans links, etc.
 
         https://openbase.com/python/easyocr
         :param fp:
-        :param lang: List of language codes to use. e.g ['ch_sim', 'en]
+        :param lang: Language code or tuple of language codes to use. e.g ('ch_sim', 'en')
         :return: List of tuples. e.g ('Meow', 0.943947975492). Trigger, Certainty.
         """
 
-        result = []
-
-        if lang not in self.easyocr_readers:
-            self.easyocr_readers[lang] = easyocr.Reader([lang])
-
-        for easyocr_reader_key in self.easyocr_readers:
-            if easyocr_reader_key == lang:
-                result = self.easyocr_readers[easyocr_reader_key].readtext(fp)
+        langs = (lang,) if type(lang) is str else tuple(lang)
+        result = self.easyocr_readers.get(langs).readtext(fp)
 
         results = []
         for tupl in result:
             results.append((tupl[1], tupl[2]))
 
         return results
+
+    def read_images_easyocr(self, images: list, lang: Union[str, tuple]) -> list[list]:
+        """ read_image_easyocr for a batch of same-sized images, which easyocr's detector and recognizer then run on
+        together. Returns each image's results in order. """
+        langs = (lang,) if type(lang) is str else tuple(lang)
+        batch_results = self.easyocr_readers.get(langs).readtext_batched(images, batch_size=len(images))
+        return [[(tupl[1], tupl[2]) for tupl in result] for result in batch_results]
+
+
+def _init_worker(barrier: threading.Barrier, reader_budget: int) -> None:
+    """ Runs once in every OCRExecutor worker process. Its easyocr Readers are loaded by OCRExecutor.preload. """
+    global _worker_reader, _worker_barrier
+    _worker_barrier = barrier
+    _worker_reader = ImageReaderTesseract(reader_budget)
+    logger.info(f'OCR worker {os.getpid()} loaded')
+
+
+def _read_engines(fp, media=None, lang_easyocr='en', lang_pytes='eng', engines: tuple = ENGINES) -> dict:
+    return _worker_reader.read_engines(fp, media, lang_easyocr=lang_easyocr, lang_pytes=lang_pytes, engines=engines)
+
+
+def _read_easyocr_batch(images: list, lang: Union[str, tuple]) -> list[list]:
+    return _worker_reader.read_images_easyocr(images, lang)
+
+
+def _ready() -> int:
+    """ A worker only takes tasks once its initializer has finished, and each waits here for the rest of the pool, so
+    pool_size of these all finishing means every worker has started """
+    _wait_for_pool()
+    return os.getpid()
+
+
+def _preload(lang_groups: list) -> None:
+    for langs in lang_groups:
+        if langs not in _worker_reader.easyocr_readers:
+            _worker_reader.easyocr_readers.get(langs)
+    _wait_for_pool()
+
+
+def _wait_for_pool() -> None:
+    """ Blocks until every worker in the pool is running the same task. A worker waiting here can't pick up another
+    task, so pool_size tasks that end with this run exactly once in each worker. """
+    try:
+        _worker_barrier.wait(BARRIER_TIMEOUT)
+    except threading.BrokenBarrierError:
+        logger.info(f'OCR worker {os.getpid()} gave up waiting on the rest of the pool')
+
+
+class OCRBatcher:
+    """
+    Collects images waiting for easyocr, from the frames of one video or from submissions being read at the same time,
+    into batches that a worker reads in one go. Only images with the same size and languages can share a batch.
+    A batch is sent once it has max_size images, or max_wait seconds after its first image arrived.
+    Batches are read through run_in_pool, see OCRExecutor.run.
+    """
+
+    def __init__(self, run: Callable, max_size: int, max_wait: float):
+        self.run_in_pool = run
+        self.max_size = max_size
+        self.max_wait = max_wait
+        # (langs, shape) -> [(image, future), ...]
+        self.pending = {}
+        self.timers = {}
+        self.running = set()
+        self.batches = 0
+        self.batched_images = 0
+
+    async def read(self, image: np.ndarray, langs: Union[str, tuple]) -> list:
+        loop = asyncio.get_running_loop()
+        key = (langs, image.shape)
+        future = loop.create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append((image, future))
+        if len(batch) >= self.max_size:
+            self.flush(key)
+        elif len(batch) == 1:
+            self.timers[key] = loop.call_later(self.max_wait, self.flush, key)
+
+        return await future
+
+    def flush(self, key: tuple) -> None:
+        if timer := self.timers.pop(key, None):
+            timer.cancel()
+
+        # Images whose read was cancelled in the meantime, e.g by an early stop, are dropped
+        batch = [(image, future) for image, future in self.pending.pop(key, []) if not future.done()]
+        if batch:
+            task = asyncio.ensure_future(self.run(key[0], batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def run(self, langs: Union[str, tuple], batch: list) -> None:
+        self.batches += 1
+        self.batched_images += len(batch)
+        try:
+            results = await self.run_in_pool(_read_easyocr_batch, [image for image, _ in batch], langs)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> str:
+        average = self.batched_images / self.batches if self.batches else 0
+        return f'batches: {self.batches}, images: {self.batched_images}, average batch size: {average:.1f}'
+
+
+class OCRExecutor:
+    """
+    Runs ImageReaderTesseract in a pool of worker processes so OCR uses every core and never blocks the event loop.
+    Each worker loads the easyocr Readers the configs use once, see preload. Has the same read_engines signature as
+    ImageReaderTesseract, but it must be awaited.
+    A worker dying, e.g killed for running out of memory, breaks the whole pool, so it's then replaced, see run.
+    """
+
+    def __init__(self, pool_size: int = 0):
+        self.pool_size = pool_size if pool_size > 0 else os.cpu_count()
+        self.executor = None
+        self.start()
+        self.batcher = OCRBatcher(self.run, easyocr_batch_size, easyocr_batch_wait)
+        self.ready_futures = []
+        self.preload_futures = []
+        self.lang_groups = []
+        self.restarts = 0
+
+    def start(self) -> None:
+        context = multiprocessing.get_context()
+        # The workers share easyocr_reader_budget between them
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.pool_size, mp_context=context, initializer=_init_worker,
+            initargs=(context.Barrier(self.pool_size), max(1, easyocr_reader_budget // self.pool_size)))
+
+    def warm_up(self) -> None:
+        """ Starts every worker process now rather than on the first submission, and returns straight away while
+        they start in the background. Call before any threads are started, as the workers are forked from
+        this process. """
+        self.ready_futures = [self.executor.submit(_ready) for _ in range(self.pool_size)]
+        logger.info(f'Starting {self.pool_size} OCR worker processes')
+
+    async def wait_ready(self) -> None:
+        """ Waits until the workers started by warm_up have loaded the Readers given to preload and are taking work """
+        pids = await asyncio.gather(*(asyncio.wrap_future(future) for future in self.ready_futures))
+        await asyncio.gather(*(asyncio.wrap_future(future) for future in self.preload_futures))
+        if len(set(pids)) != self.pool_size:
+            # Only after a worker gave up at the barrier, see _wait_for_pool
+            logger.info(f'Only {len(set(pids))}/{self.pool_size} OCR worker processes reported ready')
+        logger.info(f'Started {self.pool_size} OCR worker processes')
+
+    def preload(self, lang_groups: list) -> None:
+        """ Loads the easyocr Readers for the given language groups in every worker, without waiting for them.
+        Each preload ends at the pool's barrier, so every worker runs exactly one of them. See wait_ready. """
+        self.lang_groups = lang_groups
+        self.preload_futures = [self.executor.submit(_preload, lang_groups) for _ in range(self.pool_size)]
+
+    async def run(self, function: Callable, *args):
+        """ Runs function in a worker. When the pool is broken, the pool is restarted and function is tried once more
+        in the new one. """
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = self.executor
+            try:
+                return await loop.run_in_executor(executor, function, *args)
+            except BrokenProcessPool:
+                self.restart(executor)
+                if attempt:
+                    raise
+
+    def restart(self, broken: ProcessPoolExecutor) -> None:
+        """ Replaces a broken pool with a new one, loading the same models in its workers """
+        if broken is not self.executor:
+            # Another read that was running in the broken pool already replaced it
+            return
+
+        self.restarts += 1
+        logger.error(f'An OCR worker process died, restarting the pool. Restarts: {self.restarts}')
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.start()
+        self.warm_up()
+        if self.lang_groups:
+            self.preload(self.lang_groups)
+
+    async def read_engines(self, fp, media=None, lang_easyocr='en', lang_pytes='eng', engines: tuple = ENGINES) -> dict:
+        """ Decoded images are read by easyocr in batches, see OCRBatcher. Anything else, e.g a url, is read on its own. """
+        if 'easyocr' not in engines or not isinstance(fp, np.ndarray) or lang_easyocr == 'INVALID':
+            return await self.run(_read_engines, fp, media, lang_easyocr, lang_pytes, engines)
+
+        other_engines = tuple(engine for engine in engines if engine != 'easyocr')
+        easyocr_result, engine_results = await asyncio.gather(
+            self.batcher.read(fp, lang_easyocr),
+            self.run(_read_engines, fp, media, lang_easyocr, lang_pytes, other_engines)
+            if other_engines else asyncio.sleep(0, {}))
+        return {'easyocr': easyocr_result, **engine_results}
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,282 @@
+""" OCRAutoModerator OCR result cache
+@authors:
+---
+https://github.com/theimperious1
+https://www.reddit.com/user/theimperious1
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Union
+import aiosqlite
+import numpy as np
+from differencer import diff_hash_batch
+from OCRAutoModerator.config.config import db_path, ocr_cache_max_entries, ocr_cache_max_age, media_hash_distance, \
+    media_thumbnail_tolerance, author_cache_max_entries, author_cache_ttls, author_cache_default_ttl
+from OCRAutoModerator.data_types import MediaHash
+from OCRAutoModerator.hash_index import HashIndex, to_signed_64
+from OCRAutoModerator.utils import run_praw
+
+logger = logging.getLogger(__name__)
+
+# How many inserts happen between eviction passes
+EVICT_INTERVAL = 500
+# Side length of the greyscale thumbnails near duplicate media is compared with
+THUMBNAIL_SIDE = 64
+# Stands in for a fact that isn't cached, as None is a valid fact
+MISSING = object()
+
+
+def hash_images(images: list) -> list[MediaHash]:
+    """ Returns the MediaHash identifying each image or frame. Blocking. """
+    hashes = []
+    for image, dhash in zip(images, diff_hash_batch(images).tolist()):
+        sha = hashlib.sha256(str(image.shape).encode())
+        sha.update(np.ascontiguousarray(image).data)
+        hashes.append(MediaHash(sha.hexdigest(), dhash, 'x'.join(map(str, image.shape)), get_thumbnail(image)))
+    return hashes
+
+
+def get_thumbnail(image: np.ndarray) -> bytes:
+    """ THUMBNAIL_SIDE square greyscale copy of an image. Fine enough that a new caption or watermark changes some of
+    its pixels by more than media_thumbnail_tolerance, which an 8x8 dhash doesn't notice. """
+    import cv2
+    grey = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    return cv2.resize(grey, (THUMBNAIL_SIDE, THUMBNAIL_SIDE), interpolation=cv2.INTER_AREA).tobytes()
+
+
+def is_same_media(thumbnail: bytes, other: bytes) -> bool:
+    difference = np.abs(np.frombuffer(thumbnail, np.uint8).astype(np.int16) - np.frombuffer(other, np.uint8))
+    return int(difference.max()) <= media_thumbnail_tolerance
+
+
+class OCRCache:
+    """
+    SQLite backed cache of OCR results, keyed by (sha256, engine, lang).
+    When the exact bytes differ, e.g a re-encoded repost, the result of media within media_hash_distance bits of its
+    perceptual dhash is used instead, but only if it's the same size and its thumbnail matches too, see is_same_media.
+    Database errors are treated as misses, so a locked database only costs an OCR read.
+    """
+
+    def __init__(self):
+        self.hash_index = HashIndex()
+        self.hits = 0
+        self.perceptual_hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.inserts = 0
+        # rowid -> time of the hits since the last eviction, written out in one go by evict
+        self.last_used = {}
+
+    async def setup(self) -> None:
+        await self.hash_index.setup()
+        await self.hash_index.load()
+        async with aiosqlite.connect(db_path) as db:
+            await db.execute(
+                "CREATE TABLE IF NOT EXISTS ocr_cache (sha256 TEXT NOT NULL, dhash INTEGER NOT NULL, "
+                "engine TEXT NOT NULL, lang TEXT NOT NULL, result TEXT NOT NULL, created INTEGER NOT NULL, "
+                "last_used INTEGER NOT NULL, PRIMARY KEY (sha256, engine, lang))")
+            await db.execute("CREATE INDEX IF NOT EXISTS ocr_cache_last_used ON ocr_cache (last_used)")
+            await db.commit()
+
+    async def get(self, media_hash: MediaHash, engine: str, lang: str) -> Union[list, None]:
+        try:
+            row = await self.find(media_hash, engine, lang)
+        except aiosqlite.Error:
+            logger.exception('OCR cache lookup failed, reading the media instead')
+            self.errors += 1
+            row = None
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.last_used[row[0]] = int(time.time())
+        return [tuple(item) for item in json.loads(row[1])]
+
+    async def find(self, media_hash: MediaHash, engine: str, lang: str) -> Union[tuple, None]:
+        """ Returns the (rowid, result) row for the media, or for a repost of it """
+        async with aiosqlite.connect(db_path) as db:
+            rows = await db.execute("SELECT rowid, result FROM ocr_cache WHERE sha256 = ? AND engine = ? AND lang = ?",
+                                    (media_hash.sha, engine, lang))
+            async with rows as cursor:
+                row = await cursor.fetchone()
+            if row is not None:
+                self.hits += 1
+                return row
+
+            for media_id, _ in self.hash_index.query(media_hash.dhash, media_hash_distance):
+                rows = await db.execute(
+                    "SELECT ocr_cache.rowid, result, thumbnail FROM ocr_cache JOIN media_hashes "
+                    "ON ocr_cache.sha256 = media_hashes.sha256 "
+                    "WHERE media_hashes.rowid = ? AND shape = ? AND engine = ? AND lang = ?",
+                    (media_id, media_hash.shape, engine, lang))
+                async with rows as cursor:
+                    row = await cursor.fetchone()
+                if row is not None and row[2] is not None and is_same_media(media_hash.thumbnail, row[2]):
+                    self.perceptual_hits += 1
+                    return row[:2]
+
+        return None
+
+    async def put(self, media_hash: MediaHash, engine: str, lang: str, result: list) -> None:
+        # easyocr confidences are numpy floats, pytesseract's is the string 'No Data'
+        result = [(text, confidence if isinstance(confidence, str) else float(confidence))
+                  for text, confidence in result]
+        now = int(time.time())
+        try:
+            async with aiosqlite.connect(db_path) as db:
+                await db.execute(
+                    "INSERT OR REPLACE INTO ocr_cache (sha256, dhash, engine, lang, result, created, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (media_hash.sha, to_signed_64(media_hash.dhash), engine, lang, json.dumps(result), now, now))
+                await db.commit()
+
+            await self.hash_index.insert(media_hash.sha, media_hash.dhash, media_hash.shape, media_hash.thumbnail)
+
+            self.inserts += 1
+            if self.inserts % EVICT_INTERVAL == 0:
+                await self.evict()
+        except aiosqlite.Error:
+            logger.exception('Failed to cache OCR result')
+            self.errors += 1
+
+    async def evict(self) -> None:
+        """ Drops results older than ocr_cache_max_age days, then the least recently used beyond ocr_cache_max_entries """
+        last_used, self.last_used = self.last_used, {}
+        async with aiosqlite.connect(db_path) as db:
+            await db.executemany("UPDATE ocr_cache SET last_used = ? WHERE rowid = ?",
+                                 [(used, rowid) for rowid, used in last_used.items()])
+            await db.execute("DELETE FROM ocr_cache WHERE created < ?",
+                             (int(time.time()) - ocr_cache_max_age * 60 * 60 * 24,))
+            rows = await db.execute("SELECT COUNT(*) FROM ocr_cache")
+            async with rows as cursor:
+                count = (await cursor.fetchone())[0]
+
+            if count > ocr_cache_max_entries:
+                await db.execute(
+                    "DELETE FROM ocr_cache WHERE rowid IN (SELECT rowid FROM ocr_cache ORDER BY last_used LIMIT ?)",
+                    (count - ocr_cache_max_entries,))
+            # Evicted media stays in the in-memory index until the next restart, lookups on it just miss
+            await db.execute("DELETE FROM media_hashes WHERE sha256 NOT IN (SELECT sha256 FROM ocr_cache)")
+            await db.commit()
+
+        logger.info(f'OCR cache evicted. {self.stats()}')
+
+    def stats(self) -> str:
+        lookups = self.hits + self.perceptual_hits + self.misses
+        hit_rate = (self.hits + self.perceptual_hits) / lookups * 100 if lookups else 0
+        return f'hits: {self.hits}, perceptual hits: {self.perceptual_hits}, misses: {self.misses}, ' \
+               f'errors: {self.errors}, hit rate: {hit_rate:.1f}%'
+
+
+class AuthorCache:
+    """
+    Facts about submission authors, e.g karma or mod notes, shared by every rule and every submission by the same
+    author, so a spammer posting ten times in an hour is only looked up once. Each fact is kept for its
+    author_cache_ttls seconds, in memory for the most recently used author_cache_max_entries and in SQLite for the rest
+    and across restarts. Concurrent lookups of the same fact share a single Reddit request.
+    Database errors are treated as misses, so a locked database only costs a Reddit request.
+    """
+
+    def __init__(self):
+        # (author, fact) -> (value, expires)
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.stored_hits = 0
+        self.shared = 0
+        self.misses = 0
+        self.errors = 0
+
+    async def setup(self) -> None:
+        async with aiosqlite.connect(db_path) as db:
+            await db.execute(
+                "CREATE TABLE IF NOT EXISTS author_cache (author TEXT NOT NULL, fact TEXT NOT NULL, "
+                "value TEXT NOT NULL, expires INTEGER NOT NULL, PRIMARY KEY (author, fact))")
+            await db.commit()
+
+    async def get(self, author: str, fact: str, fetch: Callable):
+        """ Returns a cached fact, otherwise calls fetch in the praw thread to look it up and caches that.
+        fact may be scoped, e.g 'mod_notes/subreddit', its TTL is the one for the part before the slash. """
+        key = (author.lower(), fact)
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > time.time():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+        if key in self.pending:
+            self.shared += 1
+        else:
+            self.pending[key] = asyncio.create_task(self.load(key, fetch))
+        # Shielded so a lookup cancelled along with its submission's OCR doesn't cancel it for everyone else
+        return await asyncio.shield(self.pending[key])
+
+    async def load(self, key: tuple, fetch: Callable):
+        try:
+            try:
+                value, expires = await self.get_stored(key)
+            except aiosqlite.Error:
+                logger.exception('Author cache lookup failed, fetching the fact instead')
+                self.errors += 1
+                value, expires = MISSING, 0
+
+            if value is MISSING:
+                value = await run_praw(fetch)
+                expires = int(time.time()) + author_cache_ttls.get(key[1].split('/')[0], author_cache_default_ttl)
+                self.misses += 1
+                await self.put_stored(key, value, expires)
+            else:
+                self.stored_hits += 1
+
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > author_cache_max_entries:
+                self.entries.popitem(last=False)
+            return value
+        finally:
+            del self.pending[key]
+
+    @staticmethod
+    async def get_stored(key: tuple) -> tuple:
+        async with aiosqlite.connect(db_path) as db:
+            rows = await db.execute(
+                "SELECT value, expires FROM author_cache WHERE author = ? AND fact = ? AND expires > ?",
+                (*key, int(time.time())))
+            async with rows as cursor:
+                row = await cursor.fetchone()
+
+        return (MISSING, 0) if row is None else (json.loads(row[0]), row[1])
+
+    async def put_stored(self, key: tuple, value, expires: int) -> None:
+        try:
+            async with aiosqlite.connect(db_path) as db:
+                await db.execute(
+                    "INSERT OR REPLACE INTO author_cache (author, fact, value, expires) VALUES (?, ?, ?, ?)",
+                    (*key, json.dumps(value), expires))
+                await db.commit()
+
+            if self.misses % EVICT_INTERVAL == 0:
+                await self.evict()
+        except aiosqlite.Error:
+            logger.exception('Failed to cache author fact')
+            self.errors += 1
+
+    async def evict(self) -> None:
+        """ Drops expired facts from the database. Expired facts in memory are replaced the next time they're used. """
+        async with aiosqlite.connect(db_path) as db:
+            await db.execute("DELETE FROM author_cache WHERE expires <= ?", (int(time.time()),))
+            await db.commit()
+
+        logger.info(f'Author cache evicted. {self.stats()}')
+
+    def stats(self) -> str:
+        lookups = self.hits + self.stored_hits + self.shared + self.misses
+        hit_rate = (lookups - self.misses) / lookups * 100 if lookups else 0
+        return f'hits: {self.hits}, database hits: {self.stored_hits}, shared lookups: {self.shared}, ' \
+               f'misses: {self.misses}, errors: {self.errors}, hit rate: {hit_rate:.1f}%'
@@ -5,25 +5,31 @@ https://github.com/theimperious1
 https://www.reddit.com/user/theimperious1
 """
 
+import asyncio
 import logging
+import random
 from typing import Union
 from PIL import Image
 import os
+import subprocess
 import traceback
 import urllib.request
-from OCRAutoModerator.data_types import VideoData, GifData
 from enum import IntEnum
-import cv2
-from moviepy.video.io.ffmpeg_tools import ffmpeg_extract_subclip
-from OCRAutoModerator.youtube_downloader import download_yt_video
+import numpy as np
 from praw.models import Submission
-from OCRAutoModerator.data_types import MatchSets
+from OCRAutoModerator.data_types import MediaHash
+from OCRAutoModerator.utils import image_to_array
+from OCRAutoModerator.managers.cache_manager import hash_images
+from OCRAutoModerator.preprocessing import preprocess, get_frames_scale, get_text_scores
+from OCRAutoModerator.managers.wiki_manager import WikiConfig
+from OCRAutoModerator.config.config import frame_dedup_tolerance, video_max_frames, video_min_frame_spacing, \
+    video_scene_checks_per_second, video_window, gif_frame_spacing, cascade_min_confidence, \
+    text_gate, text_gate_min_score, text_gate_audit_rate
 
 logger = logging.getLogger(__name__)
 
 # Paths
 VIDEO_PATH = 'videos/'
-TMP_PATH = 'tmp/{}'
 
 
 # Media type enum
@@ -49,90 +55,179 @@ def setup_urllib():
 
 class MediaManager:
 
-    def __init__(self, reddit, auto_mod_manager, image_reader):
+    def __init__(self, reddit, auto_mod_manager, image_reader, ocr_cache):
         self.reddit = reddit
         self.auto_mod_manager = auto_mod_manager
         self.ir = image_reader
+        self.ocr_cache = ocr_cache
+        # How many images the 'fast' engine mode read with tesseract alone, and how many needed easyocr too
+        self.cascade_skips = 0
+        self.cascade_escalations = 0
+        # How many images the text gate scored and skipped. Some skipped images are read anyway (audited), and the
+        # ones that turn out to have text are counted as misses
+        self.gate_checked = 0
+        self.gate_skipped = 0
+        self.gate_audited = 0
+        self.gate_misses = 0
         setup_urllib()
 
-    async def check_image(self, submission: Submission, media, config: list) -> MatchSets:
-        required_langs = set()
-        for rule_set in config:
-            if rule_set['lang_easyocr'] not in required_langs and rule_set['lang_pytes'] not in required_langs:
-                required_langs.add((rule_set['lang_easyocr'], rule_set['lang_pytes']))
-
-        merged_result = []
-        for lang_tuple in required_langs:
-            merged_result.extend(
-                self.ir.read_all_methods(submission.url, media, lang_easyocr=lang_tuple[0], lang_pytes=lang_tuple[1]))
-
-        return await self.auto_mod_manager.check_against_rules(submission, merged_result, config)
-
-    async def check_video(self, submission: Submission, config: list) -> list:
-        media_data = self.process_media(submission)
-        required_langs = set()
-        for rule_set in config:
-            if rule_set['lang_easyocr'] not in required_langs and rule_set['lang_pytes'] not in required_langs:
-                required_langs.add((rule_set['lang_easyocr'], rule_set['lang_pytes']))
-
-        match_sets = []
-        for fp in media_data:
-            merged_result = []
-
-            for lang_tuple in required_langs:
-                merged_result.extend(self.ir.read_all_methods(fp, lang_easyocr=lang_tuple[0], lang_pytes=lang_tuple[1]))
-                match_sets.append(await self.auto_mod_manager.check_against_rules(submission, merged_result, config))
-
-        return match_sets
-
-    async def check_multi_media(self, submission: Submission, media: set, config: list) -> set:
-        logger.info('WARNING: MULTI MEDIA UNHANDLED. IMPLEMENTATION UNFINISHED')
-        return set()
-
-        results = set()
-        for item in media:
-            if item['e'] == 'Image':
-                results.add(await self.check_image(submission, item, config))
-            elif item['e'] == 'Video':
-                results.add(await self.check_video(submission, item))
+    async def read_image(self, submission: Submission, media, config: WikiConfig, stop=None,
+                         engine_mode: str = 'both') -> list:
+        """ OCRs a single image in every language the config requires.
+        The image is decoded and preprocessed once and the resulting tiles are handed to both engines, rather than
+        easyocr downloading submission.url again for every language. """
+        # Decoding a large image takes a while too, so it happens in the thread along with the preprocessing
+        tiles = await asyncio.to_thread(lambda: preprocess(image_to_array(media)))
+        return await self.read_buffers(tiles, config, stop, engine_mode)
+
+    async def read_frames(self, frames: list, config: WikiConfig, stop=None, engine_mode: str = 'both') -> list:
+        """ OCRs extracted video/gif frames in every language the config requires.
+        Every frame is submitted to the OCR executor at once so a single video can use all of its workers.
+        Frames that look the same as the last frame read, e.g a meme video with a static caption, are skipped since
+        their text would be the same as that frame's. """
+        distinct = await asyncio.to_thread(get_distinct_frames, frames, frame_dedup_tolerance)
+        if len(distinct) != len(frames):
+            logger.debug(f'Skipping OCR on {len(frames) - len(distinct)}/{len(frames)} duplicate frames')
+            frames = [frames[i] for i in distinct]
+
+        tiles = await asyncio.to_thread(preprocess_frames, frames)
+        return await self.read_buffers(tiles, config, stop, engine_mode)
+
+    async def read_buffers(self, images: list, config: WikiConfig, stop=None, engine_mode: str = 'both') -> list:
+        """ Hashes every image in one batch, then reads each one through the OCR cache.
+        With text_gate on, images that don't look like they contain text aren't read either, see gate_images.
+        stop is awaited with each engine's results as they come in. Once it returns True, e.g a remove rule matched,
+        the reads still waiting on a worker are cancelled and the text read so far is returned.
+        engine_mode is one of rules.ENGINE_MODES, see read_cascade for 'fast'. """
+        hashes = await asyncio.to_thread(hash_images, images)
+
+        audited = set()
+        if text_gate:
+            images, hashes, audited = await self.gate_images(images, hashes)
+
+        # One pass per easyocr Reader and a single tesseract pass, however many languages the config uses
+        language_plan = config.language_plan
+        passes = [('easyocr', langs) for langs in language_plan.easyocr]
+        if language_plan.pytesseract:
+            passes.append(('pytesseract', language_plan.pytesseract))
+
+        easyocr_passes = [(engine, lang) for engine, lang in passes if engine == 'easyocr']
+        if engine_mode == 'thorough' and easyocr_passes:
+            passes = easyocr_passes
+
+        # Frames are queued in order, so the start of a video is read first
+        tasks = []
+        found = set()
+        for i, (image, media_hash) in enumerate(zip(images, hashes)):
+            if engine_mode == 'fast':
+                reads = [self.read_cascade(image, media_hash, passes)]
             else:
-                logger.info(f"New Content-Type found in 'check_multi_media': {item['e']}")
-            results.add(await self.auto_mod_manager.check_against_rules(submission, item, config))
-
-        return results
-
-    async def check_text(self, submission: Submission, config: list) -> list:
-        match_sets_body = await self.auto_mod_manager.check_against_rules(submission, [submission.selftext], config)
-        # match_sets_title = await self.auto_mod_manager.check_against_rules(submission, submission.title, config)
+                reads = [self.read_cached(image, media_hash, engine, lang) for engine, lang in passes]
+            if i in audited:
+                reads = [self.read_audited(read, i, found) for read in reads]
+            tasks.extend(asyncio.create_task(read) for read in reads)
+        texts = []
+        try:
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                texts.extend(result)
+                if stop is not None and result and await stop(result):
+                    logger.debug(f'Stopped OCR early, {sum(not task.done() for task in tasks)}/{len(tasks)} reads left')
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        return texts
+
+    async def gate_images(self, images: list, hashes: list) -> tuple[list, list, set]:
+        """ Drops the images that don't look like they contain any text, keeping text_gate_audit_rate of them to be
+        read anyway. Returns the kept images and hashes, and the indexes of the audited images among them. """
+        scores = await asyncio.to_thread(get_text_scores, images)
+        kept = []
+        audited = set()
+        for i, score in enumerate(scores):
+            self.gate_checked += 1
+            if score < text_gate_min_score:
+                self.gate_skipped += 1
+                if random.random() >= text_gate_audit_rate:
+                    continue
+                self.gate_audited += 1
+                audited.add(len(kept))
+            kept.append(i)
+
+        if len(kept) != len(images):
+            logger.debug(f'Text gate skipped {len(images) - len(kept)}/{len(images)} images. {self.gate_stats()}')
+        return [images[i] for i in kept], [hashes[i] for i in kept], audited
+
+    async def read_audited(self, read, index: int, found: set) -> list:
+        """ Awaits the read of an image the text gate skipped, counting a miss if any text is found in it """
+        result = await read
+        if index not in found and any(type(text) is str and text.strip() for text, _ in result):
+            found.add(index)
+            self.gate_misses += 1
+            logger.info(f'Text gate missed text in an image: {result}. {self.gate_stats()}')
+        return result
+
+    def gate_stats(self) -> str:
+        skip_rate = self.gate_skipped / self.gate_checked if self.gate_checked else 0
+        miss_rate = self.gate_misses / self.gate_audited if self.gate_audited else 0
+        return f'checked: {self.gate_checked}, skip rate: {skip_rate:.1%}, audited: {self.gate_audited}, ' \
+               f'miss rate: {miss_rate:.1%}'
+
+    async def read_cascade(self, image, media_hash: MediaHash, passes: list) -> list:
+        """ Reads an image with tesseract, which is much faster, and with easyocr too only when tesseract found no text
+        or its confidence in the text is below cascade_min_confidence """
+        fast_passes = [(engine, lang) for engine, lang in passes if engine == 'pytesseract']
+        result = []
+        for engine, lang in fast_passes:
+            result.extend(await self.read_cached(image, media_hash, engine, lang))
+
+        if fast_passes and is_confident(result):
+            self.cascade_skips += 1
+            return result
+
+        self.cascade_escalations += 1
+        thorough_results = await asyncio.gather(*(
+            self.read_cached(image, media_hash, engine, lang) for engine, lang in passes if engine != 'pytesseract'))
+        return result + [text for thorough_result in thorough_results for text in thorough_result]
+
+    async def read_cached(self, image, media_hash: MediaHash, engine: str, lang: Union[str, tuple]) -> list:
+        """ Returns the cached OCR results for an image we've already read, e.g a repost, otherwise OCRs and caches it """
+        # easyocr language groups are cached as e.g 'de+en', the same format tesseract takes its languages in
+        cache_lang = lang if type(lang) is str else '+'.join(lang)
+        result = await self.ocr_cache.get(media_hash, engine, cache_lang)
+        if result is None:
+            engine_results = await self.ir.read_engines(image, lang_easyocr=lang, lang_pytes=lang, engines=(engine,))
+            result = engine_results[engine]
+            await self.ocr_cache.put(media_hash, engine, cache_lang, result)
+
+        return result
 
-        return match_sets_body
+    @staticmethod
+    def download(submission: Submission) -> tuple:
+        """ Downloads a video or gif to disk, returning its MediaTypes and file path. Blocking. """
+        media_type, url = get_media_type(submission)
+        return media_type, download_media(submission, url, media_type)
 
     @staticmethod
-    def process_media(submission: Submission) -> set:
-        """ Process video and store video data in memory & db """
-        fp = None
+    def extract_frames(media_type: int, fp: str) -> list:
+        """ Returns the sampled frames of a downloaded video or gif as RGB arrays and removes the download. Blocking. """
         try:
-            media_type, url = get_media_type(submission)
-            fp = download_media(submission, url, media_type)
-
-            media_data = get_gif_data(fp) if media_type == MediaTypes.GIF else get_video_data(fp)
-            logger.info(
-                f'MEDIA_DATA_DEBUG_INFO:{media_type}-{media_data.fps}-{media_data.duration}-{media_data.frame_count}')
-            images = get_gif_frames(media_data) \
-                if media_type == MediaTypes.GIF else get_video_frames(media_data)
+            images = get_gif_frames(fp) if media_type == MediaTypes.GIF else get_video_frames(fp)
+            logger.info(f'MEDIA_DATA_DEBUG_INFO:{media_type}-{len(images)}')
             return images
         except Exception:
             traceback.print_exc()
         finally:
-            if fp is not None:
-                try:
-                    os.remove(fp)
-                except FileNotFoundError:
-                    logger.info('Failed to remove video, file not found!')
-                except PermissionError:
-                    logger.info(
-                        f'The process cannot access the file because it is being used by another process: {fp}')
-        return set()
+            try:
+                os.remove(fp)
+            except FileNotFoundError:
+                logger.info('Failed to remove video, file not found!')
+            except PermissionError:
+                logger.info(
+                    f'The process cannot access the file because it is being used by another process: {fp}')
+        return []
 
 
 # TODO: secure_media['reddit_video'] has 'is_gif', we should probably start using it.
@@ -167,109 +262,138 @@ def get_media_type(submission: Submission) -> tuple:
 
 
 def download_media(submission: Submission, url: str, media_type: int) -> str:
-    """ Get video name, download it, then shorten to 60 seconds """
-    video_name = filter_video_name(url)
+    """ Get video name and download it. Only the first video_window seconds are decoded later on.
+    Names are prefixed with the submission id, as many v.redd.it fallback urls end in the same e.g DASH_720.mp4 and
+    several videos are downloaded at once. """
+    video_name = f'{submission.id}_{filter_video_name(url)}'
     fp = get_file_path(video_name)
     if media_type != MediaTypes.YOUTUBE_VIDEO:
         urllib.request.urlretrieve(url, fp)
-        # TODO: Maybe check that the videos are longer than 60s before doing sub_clip
-        if media_type != MediaTypes.GIF:
-            return get_sub_clip(video_name, fp)
     else:
+        # pytube is only needed for the odd YouTube link, so it isn't imported until then
+        from OCRAutoModerator.youtube_downloader import download_yt_video
         success = download_yt_video(submission, url, file_name=video_name)
-        if success:
-            fp = get_sub_clip(video_name, fp)
-        elif not success:
+        if not success:
             raise ConnectionError('Failed to download YouTube video')
 
     return fp
 
 
-def get_video_frames(media_data: VideoData) -> set:
-    """ Write video frames to tmp dir, incrementing by fps for 1 frame per second """
-    frame = 0
-    count = 0
-    frames = set()
-    vid_cap = media_data.cap
-    fps = media_data.fps
-    while vid_cap.isOpened():
-        success, image = vid_cap.read()
-
-        if success:
-            video = os.path.join(TMP_PATH.format(f'frame{count}.jpg'))
-            frames.add(video)
-            cv2.imwrite(video, image)
-
-            frame += fps
-            vid_cap.set(1, frame)
-            count += 1
-            if count == 59:
-                vid_cap.release()
+def get_video_frames(fp: str) -> list:
+    """ Returns video frames as RGB arrays, keeping only the frames where the picture (or its text) changes.
+    ffmpeg decodes the first video_window seconds and pipes out video_scene_checks_per_second raw frames per second,
+    without re-encoding or writing anything to disk. Each piped frame's small greyscale thumbnail is compared with the
+    last kept frame's, and the frame is kept when any pixel differs by more than frame_dedup_tolerance, see
+    is_new_frame, and it's at least video_min_frame_spacing seconds after the last kept frame. ffmpeg is stopped as
+    soon as video_max_frames are kept. """
+    from imageio_ffmpeg import get_ffmpeg_exe
+
+    command = [
+        get_ffmpeg_exe(), '-loglevel', 'error', '-t', str(video_window), '-i', fp, '-an',
+        '-vf', f'fps={video_scene_checks_per_second}', '-f', 'image2pipe', '-vcodec', 'ppm', '-'
+    ]
+    min_spacing = max(1, round(video_scene_checks_per_second * video_min_frame_spacing))
+
+    frames = []
+    sample = 0
+    last_kept = -min_spacing
+    last_thumbnail = None
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
+        try:
+            while len(frames) < video_max_frames and (image := read_ppm(process.stdout)) is not None:
+                if sample - last_kept >= min_spacing:
+                    thumbnail = get_thumbnail(image).astype(np.int16)
+                    if last_thumbnail is None or is_new_frame(thumbnail, last_thumbnail, frame_dedup_tolerance):
+                        frames.append(image)
+                        last_kept = sample
+                        last_thumbnail = thumbnail
+                sample += 1
+        finally:
+            process.kill()
+
+    return frames
+
+
+def preprocess_frames(frames: list) -> list:
+    """ Preprocesses every frame at the same scale, keeping them in order so the start of a video is still read first.
+    Blocking. """
+    if not frames:
+        return []
+    scale = get_frames_scale(frames)
+    return [tile for frame in frames for tile in preprocess(frame, scale)]
+
+
+def is_confident(result: list) -> bool:
+    """ Whether tesseract found some text and is at least cascade_min_confidence sure of all of it.
+    Results read through pytesseract have no confidence ('No Data'), so they never are. """
+    texts = [(text, confidence) for text, confidence in result if type(text) is str and text.strip()]
+    return bool(texts) and all(type(confidence) is not str and confidence >= cascade_min_confidence
+                               for _, confidence in texts)
+
+
+def read_ppm(stream) -> Union[np.ndarray, None]:
+    """ Reads one binary PPM frame, as written by ffmpeg's ppm encoder, from a stream. None at the end of the stream """
+    if stream.readline().strip() != b'P6':
+        return None
+    width, height = map(int, stream.readline().split())
+    stream.readline()  # max value, always 255 for rgb24
+    size = width * height * 3
+    data = stream.read(size)
+    if len(data) != size:
+        return None
+    return np.frombuffer(data, dtype=np.uint8).reshape((height, width, 3))
+
+
+def get_thumbnail(image: np.ndarray) -> np.ndarray:
+    """ Small greyscale copy of a frame, cheap enough to compare every sampled frame with """
+    import cv2
+    grey = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    return cv2.resize(grey, (32, 32), interpolation=cv2.INTER_AREA)
+
+
+def get_gif_frames(fp: str) -> list:
+    """ Returns gif frames as RGB arrays, decoding the gif once.
+    Frame durations are added up as the gif is read, and the frame on screen at every gif_frame_spacing seconds is
+    taken, up to video_max_frames frames or video_window seconds. """
+    frames = []
+    timestamp = 0  # milliseconds
+    next_sample = 0
+    with Image.open(fp) as gif:
+        while len(frames) < video_max_frames and timestamp < video_window * 1000:
+            # Browsers play frames with no or a 0ms duration at 100ms, so do the same
+            frame_duration = gif.info.get('duration') or 100
+            if next_sample < timestamp + frame_duration:
+                frames.append(image_to_array(gif))
+                while next_sample < timestamp + frame_duration:
+                    next_sample += gif_frame_spacing * 1000
+            timestamp += frame_duration
+
+            try:
+                gif.seek(gif.tell() + 1)
+            except EOFError:
                 break
-        else:
-            vid_cap.release()
 
     return frames
 
 
-def get_gif_frames(media_data: GifData) -> set:
-    gif = media_data.gif
-    gif.seek(0)
+def get_distinct_frames(frames: list, tolerance: int) -> list:
+    """ Returns the indexes of the frames that are a new frame compared with the last kept one, see is_new_frame.
+    Blocking. """
+    distinct = []
+    last_thumbnail = None
+    for i, frame in enumerate(frames):
+        thumbnail = get_thumbnail(frame).astype(np.int16)
+        if last_thumbnail is None or is_new_frame(thumbnail, last_thumbnail, tolerance):
+            distinct.append(i)
+            last_thumbnail = thumbnail
 
-    current_frame = 0
-    count = 0
-    frames = set()
-    while True:
-        try:
-            gif.seek(current_frame)
-            output = TMP_PATH.format(f'frame{current_frame}.png')
-            gif.save(output)
-            frames.add(output)
-            current_frame += media_data.fps
-            count += 1
-            if count == 59:
-                gif.close()
-                return frames
-        except EOFError:
-            gif.close()
-            return frames
-
-
-def get_video_data(fp: str) -> VideoData:
-    """ Get's relevant data for a video """
-    cap = cv2.VideoCapture(fp)
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = cap.get(cv2.CAP_PROP_FPS)  # TODO: THIS MAY NOT BE ACCURATE, getting 45 seconds on 2 min 9 sec long vids.
-    duration = frame_count / fps
-    return VideoData(cap, duration, frame_count, fps)
-
-
-def get_gif_data(fp: str) -> GifData:
-    """ Gets GifData from a gif and then returns it with a vidcap
-    total_duration will be in milliseconds
-    """
-    # TODO: NoneType object has no attribute 'seek'. Why? This happened multiple time.
-    gif = Image.open(fp)
-    gif.seek(0)
-    total_duration = 0
-    frame_count = 0
-    while True:
-        try:
-            frame_duration = gif.info['duration']  # returns current frame duration in milli sec.
-            total_duration += frame_duration
-            frame_count += 1
-            # now move to the next frame of the gif
-            gif.seek(gif.tell() + 1)  # image.tell() = current frame
-        except EOFError:
-            fps = ((frame_count / total_duration) * 1000) if total_duration != 0 else 0
-            return GifData(gif, total_duration, frame_count, round(fps))
-
-
-def get_sub_clip(video_name: str, fp: str) -> str:
-    new_video = f'{VIDEO_PATH}1-{video_name}'
-    ffmpeg_extract_subclip(fp, 0, 59 * 1000, targetname=new_video)
-    os.remove(fp)
-    return new_video
+    return distinct
+
+
+def is_new_frame(thumbnail: np.ndarray, last_thumbnail: np.ndarray, tolerance: int) -> bool:
+    """ Whether at least one pixel of two int16 thumbnails differs by more than tolerance. Unlike a mean difference or
+    an 8x8 dhash, this notices a caption or subtitle appearing or changing over the same background. """
+    return int(np.abs(thumbnail - last_thumbnail).max()) > tolerance
 
 
 def get_total_frames(clips: list, clip_length: int) -> int:
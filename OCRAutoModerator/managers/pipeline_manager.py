@@ -0,0 +1,160 @@
+""" OCRAutoModerator Submission Pipeline
+@authors:
+---
+https://github.com/theimperious1
+https://www.reddit.com/user/theimperious1
+"""
+
+import asyncio
+import logging
+import traceback
+from enum import IntEnum
+from praw.models import Submission
+from OCRAutoModerator.config.config import pipeline_queue_size, pipeline_fetch_workers, pipeline_decode_workers, \
+    pipeline_ocr_workers, pipeline_rule_workers, pipeline_action_workers
+from OCRAutoModerator.data_types import PipelineJob
+from OCRAutoModerator.managers.wiki_manager import WikiConfig
+from OCRAutoModerator.rules import get_engine_mode
+from OCRAutoModerator.utils import fetch_media, is_video_or_gif
+
+logger = logging.getLogger(__name__)
+
+
+class ContentTypes(IntEnum):
+    TEXT = 1
+    IMAGE = 2
+    GALLERY = 3
+    VIDEO = 4
+
+
+# noinspection PyBroadException
+class PipelineManager:
+    """
+    Moves submissions through fetch -> decode -> OCR -> rule check -> action stages.
+    Every stage has its own pool of workers and hands jobs to the next stage through a bounded queue, so a slow
+    video in the decode or OCR stage no longer holds up the images queued behind it. When a queue is full the stage
+    before it waits, which keeps memory use bounded during a spike in r/mod.
+    """
+
+    def __init__(self, submission_manager):
+        self.submission_manager = submission_manager
+        self.media_manager = submission_manager.media_manager
+        self.auto_mod_manager = submission_manager.auto_mod_manager
+
+        self.fetch_queue = asyncio.Queue(pipeline_queue_size)
+        self.decode_queue = asyncio.Queue(pipeline_queue_size)
+        # Decoded frames are held in memory, so only let a few videos' worth wait for OCR
+        self.ocr_queue = asyncio.Queue(pipeline_ocr_workers)
+        self.rule_queue = asyncio.Queue(pipeline_queue_size)
+        self.action_queue = asyncio.Queue(pipeline_queue_size)
+        self.workers = []
+        self.skipped = 0
+
+    def start(self) -> None:
+        """ Starts every stage's workers. Must be called from within the running event loop. """
+        if self.workers:
+            return
+
+        stages = (
+            ('fetch', self.fetch_queue, self.do_fetch, pipeline_fetch_workers),
+            ('decode', self.decode_queue, self.do_decode, pipeline_decode_workers),
+            ('ocr', self.ocr_queue, self.do_ocr, pipeline_ocr_workers),
+            ('rule', self.rule_queue, self.do_rules, pipeline_rule_workers),
+            ('action', self.action_queue, self.do_action, pipeline_action_workers),
+        )
+        for name, queue, handler, worker_count in stages:
+            for i in range(worker_count):
+                self.workers.append(asyncio.create_task(self.worker(queue, handler), name=f'{name}-{i}'))
+
+    async def stop(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def join(self) -> None:
+        """ Waits until every queued submission has left the pipeline """
+        for queue in (self.fetch_queue, self.decode_queue, self.ocr_queue, self.rule_queue, self.action_queue):
+            await queue.join()
+
+    async def put(self, submission: Submission, config: WikiConfig) -> None:
+        """ Listing ingest. Blocks while the fetch stage is backed up.
+        Submissions that no rule can apply to, going by their flair, nsfw, lock state etc, skip the pipeline. """
+        facts = {}
+        rules = await self.auto_mod_manager.plan_rules(submission, config, facts)
+        if not rules:
+            self.skipped += 1
+            logger.info(f'Skipped {submission.id}, no rules apply to it. {self.skipped} skipped so far')
+            return
+
+        job = PipelineJob(submission, config, rules, facts, None, None, None, None)
+        if not any(rule.rule_set['rule'] for rule in rules):
+            # Only rules on the author's links are left, which don't need the submission's text
+            await self.rule_queue.put(job._replace(content_type=ContentTypes.TEXT, text=[]))
+        else:
+            await self.fetch_queue.put(job)
+
+    @staticmethod
+    async def worker(queue: asyncio.Queue, handler) -> None:
+        while 1:
+            job = await queue.get()
+            try:
+                await handler(job)
+            except:
+                logger.info(f'Pipeline stage {handler.__name__} failed for {job.submission.id}')
+                traceback.print_exc()
+            finally:
+                queue.task_done()
+
+    async def do_fetch(self, job: PipelineJob) -> None:
+        """ Downloads images and videos. Network bound. """
+        submission = job.submission
+        media_url = submission.url_overridden_by_dest if hasattr(submission, 'url_overridden_by_dest') else None
+
+        if media := await asyncio.to_thread(fetch_media, media_url):
+            await self.ocr_queue.put(job._replace(content_type=ContentTypes.IMAGE, media=media))
+
+        elif hasattr(submission, 'media_metadata'):
+            logger.info(f'WARNING: MULTI MEDIA UNHANDLED. IMPLEMENTATION UNFINISHED. Skipped gallery {submission.id}')
+
+        elif is_video_or_gif(submission):
+            media = await asyncio.to_thread(self.media_manager.download, submission)
+            await self.decode_queue.put(job._replace(content_type=ContentTypes.VIDEO, media=media))
+
+        else:
+            await self.rule_queue.put(job._replace(content_type=ContentTypes.TEXT, text=[submission.selftext]))
+
+    async def do_decode(self, job: PipelineJob) -> None:
+        """ Extracts frames from downloaded videos and gifs. CPU bound. """
+        media_type, fp = job.media
+        frames = await asyncio.to_thread(self.media_manager.extract_frames, media_type, fp)
+        await self.ocr_queue.put(job._replace(media=frames))
+
+    async def do_ocr(self, job: PipelineJob) -> None:
+        """ Reads text from the fetched image or decoded frames using the OCR executor's worker processes.
+        If any of the job's rules are decisive, the rules are checked as each result comes in and the remaining
+        frames are dropped at the first decisive match. """
+        stop = None
+        decisive = [rule for rule in job.rules if rule.decisive]
+        if decisive:
+            async def stop(text: list) -> bool:
+                return await self.auto_mod_manager.is_decisive(job.submission, text, job.config, decisive, job.facts)
+
+        engine_mode = get_engine_mode(job.rules)
+        if job.content_type == ContentTypes.IMAGE:
+            text = await self.media_manager.read_image(job.submission, job.media, job.config, stop, engine_mode)
+        else:
+            text = await self.media_manager.read_frames(job.media, job.config, stop, engine_mode)
+
+        await self.rule_queue.put(job._replace(media=None, text=text))
+
+    async def do_rules(self, job: PipelineJob) -> None:
+        match_sets = await self.auto_mod_manager.check_against_rules(job.submission, job.text, job.config, job.rules,
+                                                                  job.facts)
+        await self.action_queue.put(job._replace(text=None, match_sets=match_sets))
+
+    async def do_action(self, job: PipelineJob) -> None:
+        submission = job.submission
+        await self.submission_manager.do_submission(submission, job.match_sets)
+        logger.info(
+            f'Scanning complete for {submission.id} by /u/{submission.author} on /r/{submission.subreddit.display_name}')
@@ -1,6 +1,6 @@
 import traceback
 from OCRAutoModerator.data_types import ActionableItem, MatchSets
-from OCRAutoModerator.utils import replace_placeholders
+from OCRAutoModerator.utils import replace_placeholders, run_praw
 from OCRAutoModerator.managers.content_managers.automod_manager import AutoModManager
 from OCRAutoModerator.managers.content_managers.media_manager import MediaManager
 from praw.models import Submission, Comment
@@ -13,10 +13,10 @@ logger = logging.getLogger(__name__)
 # noinspection PyBroadException
 class SubmissionManager:
 
-    def __init__(self, reddit, image_reader):
+    def __init__(self, reddit, image_reader, ocr_cache, author_cache):
         self.reddit = reddit
-        self.auto_mod_manager = AutoModManager(reddit)
-        self.media_manager = MediaManager(self.reddit, self.auto_mod_manager, image_reader)
+        self.auto_mod_manager = AutoModManager(reddit, author_cache)
+        self.media_manager = MediaManager(self.reddit, self.auto_mod_manager, image_reader, ocr_cache)
 
     async def do_submission(self, submission: Submission, match_sets: MatchSets) -> None:
         remove = len(match_sets.remove) > 0
@@ -43,18 +43,6 @@ class SubmissionManager:
         if report:
             await self.report(match_sets)
 
-    async def check_multi_media(self, submission: Submission, media: set, config: list) -> set:
-        return await self.media_manager.check_multi_media(submission, media, config)
-
-    async def check_image(self, submission: Submission, media, config: list) -> MatchSets:
-        return await self.media_manager.check_image(submission, media, config)
-
-    async def check_video(self, submission: Submission, config: list) -> list:
-        return await self.media_manager.check_video(submission, config)
-
-    async def check_text(self, submission: Submission, config: list) -> list:
-        return await self.media_manager.check_text(submission, config)
-
     async def report(self, match_sets: MatchSets) -> None:
         actionable: ActionableItem = match_sets.report[0]
         submission = actionable.submission
@@ -63,9 +51,10 @@ class SubmissionManager:
             # TODO: Supply submission_type instead of placeholder "Image"
             report_reason = replace_placeholders(
                 submission, 'Image', report_reason, actionable.rule_set, match_sets.report)
-            await submission.report(report_reason)
+            await run_praw(submission.report, report_reason)
         else:
-            await submission.report(
+            await run_praw(
+                submission.report,
                 f'This content appears to violate the rules. It matched {len(match_sets.report)} times.')
         # TODO: Add comment_remove to wiki manager and allow mods to have bot comment removed comments
 
@@ -79,14 +68,20 @@ class SubmissionManager:
         comment = rule_set['comment'].replace('\n', '  \n\n') if 'comment' in rule_set else default_comment
         comment = replace_placeholders(submission, 'Image', comment, rule_set, match_sets)
 
-        submission.mod.remove(mod_note=rule_set['action_reason'], spam=spam)
-        reply = submission.reply(body=comment)
+        await run_praw(submission.mod.remove, mod_note=rule_set['action_reason'], spam=spam)
+        reply = await run_praw(submission.reply, body=comment)
         await self.apply_extras(match_sets, reply)
         logger.info(
             f'\nSubmission {submission.id} on /r/{submission.subreddit.display_name} was removed and triggered {len(match_sets.remove)} matches.')
 
+    async def apply_extras(self, match_sets: MatchSets, comment: Comment = None) -> None:
+        """ Applies the flair, lock, nsfw etc. that the matched rules set. Every one of these is a praw call, so they're
+        made in the praw thread rather than blocking the pipeline, see run_praw. """
+        await run_praw(self.set_extras, match_sets, comment)
+
     @staticmethod
-    async def apply_extras(match_sets: MatchSets, comment: Comment = None) -> None:
+    def set_extras(match_sets: MatchSets, comment: Comment = None) -> None:
+        """ Blocking """
         for match_set in match_sets:
             if len(match_set) < 1:
                 continue
@@ -8,15 +8,19 @@ https://www.reddit.com/user/theimperious1
 import logging
 import re
 from collections import namedtuple
+from functools import lru_cache
 from typing import Union
 from enum import IntEnum
 import yaml
 from praw.models import Subreddit
 from OCRAutoModerator.config.config import default_wiki, bot_name, join_success, wiki_permissions_error, developers, \
     acceptable_languages_easyocr, acceptable_languages_pytesseract, language_map_pytes_to_easyocr, \
-    language_map_easyocr_to_pytes
-from OCRAutoModerator.utils import is_user_mod
+    language_map_easyocr_to_pytes, easyocr_language_scripts
+from OCRAutoModerator.data_types import LanguagePlan
+from OCRAutoModerator.utils import is_user_mod, run_praw
 from OCRAutoModerator.utils import log_and_reply
+from OCRAutoModerator.matcher import RuleMatcher
+from OCRAutoModerator.rules import CompiledRule, ENGINE_MODES
 
 logger = logging.getLogger(__name__)
 
@@ -43,6 +47,60 @@ class OperatorTypes(IntEnum):
     TIME = 2
 
 
+# e.g "rule (includes-word, case-sensitive)"
+_rule_key_regex = re.compile(r'^rule\s*\((.*)\)$')
+
+
+class WikiConfig(list):
+    """ A subreddit's list of rule_sets, along with everything compiled from them when the config is loaded """
+
+    def __init__(self, rule_sets: list):
+        super().__init__(rule_sets)
+        patterns = {}
+        for index, rule_set in enumerate(self):
+            modifiers = rule_set.get('rule_modifiers', [])
+            # Plain case-insensitive "includes" rules are matched by the Aho-Corasick automaton instead
+            if any(modifier != 'includes' for modifier in modifiers):
+                patterns[index] = compile_rule_patterns(tuple(rule_set['rule']), tuple(sorted(modifiers)))
+        self.matcher = RuleMatcher(self, patterns)
+        self.rules = [CompiledRule(index, rule_set) for index, rule_set in enumerate(self)]
+        self.language_plan = plan_languages([rule.rule_set for rule in self.rules if rule.enabled])
+
+
+def plan_languages(rule_sets: list) -> LanguagePlan:
+    """ Works out the fewest OCR passes that cover every language the rule_sets use.
+    easyocr languages are grouped into as few Readers as their recognition models allow, and tesseract reads every
+    language in one pass, e.g LanguagePlan(easyocr=(('ru',), ('de', 'en')), pytesseract='deu+eng+rus') """
+    easyocr_langs = {rule_set.get('lang_easyocr', 'en') for rule_set in rule_sets} - {'INVALID'}
+    pytes_langs = {rule_set.get('lang_pytes', 'eng') for rule_set in rule_sets} - {'INVALID'}
+
+    scripts = {}
+    for lang in easyocr_langs - {'en'}:
+        scripts.setdefault(easyocr_language_scripts.get(lang, 'latin'), set()).add(lang)
+
+    if 'en' in easyocr_langs:
+        # English fits in any Reader, so it only needs a group of its own when it's the only language
+        script = 'latin' if 'latin' in scripts or not scripts else sorted(scripts)[0]
+        scripts.setdefault(script, set()).add('en')
+
+    return LanguagePlan(tuple(tuple(sorted(langs)) for _, langs in sorted(scripts.items())),
+                        '+'.join(sorted(pytes_langs)))
+
+
+@lru_cache(maxsize=1024)
+def compile_rule_patterns(items: tuple, modifiers: tuple) -> tuple:
+    """ Compiles each item of a rule_set into a (pattern, item) pair. Items are compiled one by one, as an alternation
+    of them only reports the first of two items that overlap in a text, and joining regex items would break
+    backreferences and group names used in more than one item. Cached on the rule's contents, so unchanged rule_sets
+    are reused when a config is reloaded after a wiki revision, and identical rule_sets are shared between subreddits. """
+    match_types = [modifier for modifier in modifiers if modifier in _match_regexes]
+    match_regex = _match_regexes[match_types[0]] if match_types else _match_regexes['includes']
+    flags = re.DOTALL if 'case-sensitive' in modifiers else re.DOTALL | re.IGNORECASE
+    # regex items are grouped, so e.g a|b under full-exact is ^(?:a|b)$ rather than ^a|b$
+    return tuple((re.compile(match_regex % (f'(?:{item})' if 'regex' in modifiers else re.escape(item)), flags), item)
+                 for item in items)
+
+
 # noinspection PyBroadException
 class WikiParser:
 
@@ -56,17 +114,18 @@ class WikiParser:
         try:
             if not await self.check_wiki_exists(subreddit):
                 self.wiki_configs[sub_name.lower()] = await self.create_wiki(subreddit)
-                self.reddit.subreddit(sub_name).message(
-                    f'{bot_name} has been setup correctly!', join_success.format(sub_name))
+                await run_praw(self.reddit.subreddit(sub_name).message,
+                               f'{bot_name} has been setup correctly!', join_success.format(sub_name))
                 logger.info(f'Created Wiki Config for /r/{sub_name}')
             else:
                 self.wiki_configs[sub_name.lower()] = await self.load_wiki_config(subreddit)
-                self.reddit.subreddit(sub_name).message(
-                    f'{bot_name} has been setup correctly!', join_success.format(sub_name))
+                await run_praw(self.reddit.subreddit(sub_name).message,
+                               f'{bot_name} has been setup correctly!', join_success.format(sub_name))
                 logger.info(f'Created Wiki Config for /r/{sub_name}')
         except:
             logger.info(f'Failed to create Wiki Config for /r/{sub_name}')
-            self.reddit.subreddit(sub_name).message(f'Permissions issue with {bot_name}', wiki_permissions_error)
+            await run_praw(self.reddit.subreddit(sub_name).message, f'Permissions issue with {bot_name}',
+                           wiki_permissions_error)
 
     async def on_wiki_update_request(self, msg) -> None:
         sub_name = msg.body.replace('r/', '').replace('/', '').lower()
@@ -76,29 +135,33 @@ class WikiParser:
                 if msg.subject == 'update':
                     try:
                         self.wiki_configs[sub_name.lower()] = await self.load_wiki_config(subreddit)
-                        log_and_reply(msg, f'Wiki revision was successful! Changes have been applied to /r/{sub_name}.')
+                        await run_praw(log_and_reply, msg, f'Wiki revision was successful! '
+                                                            f'Changes have been applied to /r/{sub_name}.')
                     except Exception as e:
-                        msg.reply(
-                            body=f"Sorry, seems like theres an error with your configuration. Here's the error: {e}")
+                        await run_praw(msg.reply, body=f"Sorry, seems like theres an error with your "
+                                                       f"configuration. Here's the error: {e}")
                         logger.info(f'Wiki Update failed on /r/{sub_name}')
                 elif msg.subject == 'reset':
                     try:
                         if not await self.check_wiki_exists(subreddit):
                             self.wiki_configs[sub_name.lower()] = await self.create_wiki(subreddit)
-                            self.reddit.subreddit(sub_name).message(
-                                f'{bot_name} has been setup correctly!', join_success.format(sub_name))
+                            await run_praw(self.reddit.subreddit(sub_name).message,
+                                           f'{bot_name} has been setup correctly!',
+                                           join_success.format(sub_name))
                             logger.info(f'Created Wiki Config for /r/{sub_name}')
                         else:
                             self.wiki_configs[sub_name.lower()] = await self.reset(subreddit)
-                            msg.reply(body=f'Wiki was reset successful! Changes have been applied to /r/{sub_name}.')
+                            await run_praw(msg.reply, body=f'Wiki was reset successful! '
+                                                           f'Changes have been applied to /r/{sub_name}.')
                             logger.info(f'Wiki Reset complete on /r/{sub_name}')
 
                     except Exception as e:
-                        msg.reply(
-                            body=f"Sorry, seems like theres an error with your configuration. Here's the error: {e}")
+                        await run_praw(msg.reply, body=f"Sorry, seems like theres an error with your "
+                                                       f"configuration. Here's the error: {e}")
                         logger.info(f'Wiki Reset failed on /r/{sub_name}')
             else:
-                msg.reply(
+                await run_praw(
+                    msg.reply,
                     f"Sorry, seems like you're not a moderator of that subreddit. If this is in error, contact /u/{developers[0]}.")
                 logger.info(f"/u/{msg.author} tried to update config on sub they're not a moderator of. /r/{sub_name}")
         except Exception as e:
@@ -131,9 +194,29 @@ class WikiParser:
 
         return rule_defs
 
+    def compile(self, config: list) -> WikiConfig:
+        """ Compiles a parsed config's rule items into a single matcher, so OCR text is matched against every
+        rule_set at once rather than item by item """
+        for section in config:
+            self.parse_rule_modifiers(section)
+        return WikiConfig(config)
+
+    @staticmethod
+    def parse_rule_modifiers(section: dict) -> None:
+        """ Moves AutoModerator style modifiers from a "rule (modifier, modifier)" key into 'rule_modifiers' """
+        for key in list(section):
+            if type(key) is str and (match := _rule_key_regex.match(key.strip())):
+                if 'rule' in section:
+                    raise ValueError("'rule' can only be given once per rule.")
+
+                section['rule'] = section.pop(key)
+                section['rule_modifiers'] = [
+                    modifier.strip().lower() for modifier in match.group(1).split(',') if modifier.strip()]
+
     def validate_config(self, config: list) -> bool:
         priorities = []
         for section in config:
+            self.parse_rule_modifiers(section)
             if 'type' not in section:
                 raise ValueError("'type' parameter is missing.")
             elif 'rule' not in section:
@@ -203,9 +286,15 @@ class WikiParser:
                 raise TypeError("'ignore_reports' parameter is not a boolean value, e.g true or false.")
             elif 'satisfy_any_threshold' in section and type(section['satisfy_any_threshold']) is not bool:
                 raise TypeError("'satisfy_any_threshold' parameter is not a boolean value, e.g true or false.")
-            elif 'has_comments' in section:
+            elif 'stop_on_match' in section and type(section['stop_on_match']) is not bool:
+                raise TypeError("'stop_on_match' parameter is not a boolean value, e.g true or false.")
+            elif 'engine' in section and section['engine'] not in ENGINE_MODES:
+                raise ValueError(f"'engine' must be one of {', '.join(ENGINE_MODES)}")
+
+            if 'has_comments' in section:
                 section['has_comments'] = self.assign_operators(section['has_comments'])
-            elif 'author' in section:
+
+            if 'author' in section:
                 if type(section['author']) is not dict:
                     raise TypeError(
                         "'author' parameter is not a dictionary/group value, please refer to https://www.reddit.com/wiki/automoderator/full-documentation/ for how to do this.")
@@ -326,6 +415,29 @@ class WikiParser:
                 if len(item) > 1000:
                     raise ValueError("Items in 'rule' cannot be longer than 1000 characters")
 
+                if 'regex' in section.get('rule_modifiers', []):
+                    try:
+                        re.compile(item)
+                    except re.error as e:
+                        raise ValueError(f"The regex '{item}' in 'rule' is not valid: {e}")
+
+            if 'rule_modifiers' in section:
+                modifiers = section['rule_modifiers']
+                for modifier in modifiers:
+                    if modifier not in _match_modifiers:
+                        raise ValueError(
+                            f"'{modifier}' is not a valid rule modifier. Valid modifiers are: {', '.join(sorted(_match_modifiers))}")
+
+                if len([modifier for modifier in modifiers if modifier in _match_regexes]) > 1:
+                    raise ValueError(
+                        f"A rule can only use one of these modifiers at once: {', '.join(_match_regexes.keys())}")
+
+                # The patterns as they're compiled when the config is loaded, see WikiConfig
+                try:
+                    compile_rule_patterns(tuple(section['rule']), tuple(sorted(modifiers)))
+                except re.error as e:
+                    raise ValueError(f"The 'rule' items can't be matched with these modifiers: {e}")
+
             priorities.append(section['priority'])
 
             if 'language' in section:
@@ -415,23 +527,24 @@ class WikiParser:
     @staticmethod
     async def check_wiki_exists(subreddit: Subreddit) -> bool:
         """ Check if wiki exists in specified subreddit """
-        if f'{subreddit.display_name}/ocr_auto_moderator' in subreddit.wiki:
+        pages = await run_praw(list, subreddit.wiki)
+        if f'{subreddit.display_name}/ocr_auto_moderator' in pages:
             return True
         return False
 
-    async def create_wiki(self, subreddit: Subreddit):
+    async def create_wiki(self, subreddit: Subreddit) -> WikiConfig:
         """ Creates a wiki with the specified data """
-        subreddit.wiki.create('ocr_auto_moderator', default_wiki,
-                              'OCR AutoModerator added it\'s YAML configuration')
-        return self.parse(default_wiki)
+        await run_praw(subreddit.wiki.create, 'ocr_auto_moderator', default_wiki,
+                       'OCR AutoModerator added it\'s YAML configuration')
+        return self.compile(self.parse(default_wiki))
 
-    async def load_wiki_config(self, subreddit: Subreddit):
+    async def load_wiki_config(self, subreddit: Subreddit) -> WikiConfig:
         """ Checks if the wiki exists and loads new YAML from it if so, validating it in the process and returning
         the result. Otherwise, creates a new one with defaults."""
         if await self.check_wiki_exists(subreddit):
-            config = self.parse(subreddit.wiki['ocr_auto_moderator'].content_md)
+            config = self.parse(await run_praw(lambda: subreddit.wiki['ocr_auto_moderator'].content_md))
             if self.validate_config(config):
-                return config
+                return self.compile(config)
             # validation_response = self.validate_config(config)
             # if validation_response == True:
             #     return config
@@ -440,9 +553,9 @@ class WikiParser:
         else:
             return await self.create_wiki(subreddit)
 
-    async def reset(self, subreddit: Subreddit):
+    async def reset(self, subreddit: Subreddit) -> WikiConfig:
         """ Resets the wiki config to default if it exists """
         if await self.check_wiki_exists(subreddit):
-            subreddit.wiki['ocr_auto_moderator'].edit(default_wiki,
-                                                      'OCR AutoModerator\'s wiki config was reset as requested')
-        return self.parse(default_wiki)
+            await run_praw(subreddit.wiki['ocr_auto_moderator'].edit, default_wiki,
+                           'OCR AutoModerator\'s wiki config was reset as requested')
+        return self.compile(self.parse(default_wiki))
@@ -0,0 +1,104 @@
+""" OCRAutoModerator rule matching
+@authors:
+---
+https://github.com/theimperious1
+https://www.reddit.com/user/theimperious1
+"""
+
+from collections import deque
+
+
+class AhoCorasick:
+    """
+    Finds every one of a set of patterns in a text in a single pass over the text, however many patterns there are.
+    search() returns the ids of the patterns found, where a pattern's id is the order it was added in.
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        self.pattern_count = 0
+
+    def add(self, pattern: str) -> int:
+        node = 0
+        for char in pattern:
+            if char not in self.goto[node]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[node][char] = len(self.goto) - 1
+            node = self.goto[node][char]
+
+        self.output[node].append(self.pattern_count)
+        self.pattern_count += 1
+        return self.pattern_count - 1
+
+    def build(self) -> None:
+        """ Sets up the failure links. Must be called after the last add() and before search() """
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def search(self, text: str) -> set:
+        found = set(self.output[0])
+        goto, fail, output = self.goto, self.fail, self.output
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+
+        return found
+
+
+class RuleMatcher:
+    """
+    One automaton over every rule item in a subreddit's config, matched case-insensitively.
+    rule_sets with match modifiers (regex, includes-word, case-sensitive, etc) are matched with the precompiled
+    patterns given for them in patterns instead, one per item, e.g {rule_set index: ((re.Pattern, item), ...)}, see
+    wiki_manager.compile_rule_patterns.
+    """
+
+    def __init__(self, config: list, patterns: dict):
+        self.automaton = AhoCorasick()
+        self.patterns = list(patterns.items())
+        # pattern id -> every (rule_set index, item) with that pattern
+        self.targets = []
+        pattern_ids = {}
+        for index, rule_set in enumerate(config):
+            if index in patterns:
+                continue
+
+            for item in rule_set.get('rule', []):
+                pattern = item.lower()
+                if pattern not in pattern_ids:
+                    pattern_ids[pattern] = self.automaton.add(pattern)
+                    self.targets.append([])
+                self.targets[pattern_ids[pattern]].append((index, item))
+        self.automaton.build()
+
+    def search(self, text: str) -> dict:
+        """ Returns the matched items of every rule_set that matched, e.g {rule_set index: [item, item]} """
+        # OCR output has trailing whitespace, e.g tesseract's '\n\x0c', which would stop full-exact or ends-with matching
+        text = text.strip()
+        matches = {}
+        for pattern_id in sorted(self.automaton.search(text.lower())):
+            for index, item in self.targets[pattern_id]:
+                matches.setdefault(index, []).append(item)
+
+        for index, rule_patterns in self.patterns:
+            for pattern, item in rule_patterns:
+                if item not in matches.get(index, []) and pattern.search(text):
+                    matches.setdefault(index, []).append(item)
+
+        return matches
@@ -0,0 +1,142 @@
+""" OCRAutoModerator ONNX Runtime backend for easyocr
+@authors:
+---
+https://github.com/theimperious1
+https://www.reddit.com/user/theimperious1
+"""
+
+import argparse
+import copy
+import logging
+import os
+import torch
+import onnxruntime
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from OCRAutoModerator.config.config import onnx_model_dir, onnx_quantize
+
+logger = logging.getLogger(__name__)
+
+# Sessions by model path, so every Reader in a process shares the one CRAFT detector
+_sessions = {}
+
+
+class OnnxModel(torch.nn.Module):
+    """
+    Stands in for an easyocr detector or recognizer, running its exported graph with ONNX Runtime instead of torch.
+    Takes and returns torch tensors like the model it replaces, so easyocr's own pre and post processing is unchanged.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        if path not in _sessions:
+            _sessions[path] = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.session = _sessions[path]
+        self.input_name = self.session.get_inputs()[0].name
+        self.model_bytes = os.path.getsize(path)
+
+    def forward(self, image: torch.Tensor, *_):
+        # The recognizer is also passed the text it's predicting, which easyocr's models don't use
+        outputs = self.session.run(None, {self.input_name: image.cpu().numpy()})
+        outputs = tuple(torch.from_numpy(output) for output in outputs)
+        return outputs if len(outputs) > 1 else outputs[0]
+
+
+class MeanPool(torch.nn.Module):
+    """ Same as easyocr's AdaptiveAvgPool2d((None, 1)), which can't be exported with a dynamic image width """
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return x.mean(dim=3, keepdim=True)
+
+
+class ImageOnly(torch.nn.Module):
+    """ A recognizer taking just the image, so the exported graph has a single input """
+
+    def __init__(self, recognizer: torch.nn.Module):
+        super().__init__()
+        self.recognizer = copy.deepcopy(recognizer)
+        replace_adaptive_pools(self.recognizer)
+
+    def forward(self, image: torch.Tensor) -> torch.Tensor:
+        return self.recognizer(image, None)
+
+
+def replace_adaptive_pools(module: torch.nn.Module) -> None:
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.AdaptiveAvgPool2d) and tuple(child.output_size) == (None, 1):
+            setattr(module, name, MeanPool())
+        else:
+            replace_adaptive_pools(child)
+
+
+def export(model: torch.nn.Module, example: torch.Tensor, path: str, output_names: list, dynamic_axes: dict) -> None:
+    """ Exports a model to path, int8 quantizing it if onnx_quantize is set. Written to a temporary file first as every
+    OCR worker process may be exporting the same model at once. """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with torch.no_grad():
+        torch.onnx.export(model.eval(), example, tmp_path, input_names=['image'], output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=17, dynamo=False)
+
+    if onnx_quantize:
+        # Only the LSTM and linear layers, as torch's dynamic quantization does. Quantized convolutions are several
+        # times slower than float ones on CPU.
+        quantized_path = f'{tmp_path}.int8'
+        quantize_dynamic(tmp_path, quantized_path, weight_type=QuantType.QInt8,
+                         op_types_to_quantize=['MatMul', 'Gemm', 'LSTM'])
+        os.replace(quantized_path, tmp_path)
+
+    os.replace(tmp_path, path)
+    logger.info(f'Exported {path} ({os.path.getsize(path) / 1024 / 1024:.0f}MB)')
+
+
+def convert_reader(reader, langs: tuple):
+    """ Swaps an easyocr Reader's torch detector and recognizer for ONNX Runtime ones, exporting them the first time.
+    The Reader must be created with quantize=False, as torch's quantized layers can't be exported. """
+    os.makedirs(onnx_model_dir, exist_ok=True)
+    suffix = '.int8.onnx' if onnx_quantize else '.onnx'
+
+    detector_path = os.path.join(onnx_model_dir, f'craft{suffix}')
+    if not os.path.exists(detector_path):
+        export(reader.detector, torch.randn(1, 3, 320, 480), detector_path, ['y', 'feature'], {
+            'image': {0: 'batch', 2: 'height', 3: 'width'},
+            'y': {0: 'batch', 1: 'height', 2: 'width'},
+            'feature': {0: 'batch', 2: 'height', 3: 'width'},
+        })
+
+    recognizer_path = os.path.join(onnx_model_dir, f"recognizer_{'+'.join(langs)}{suffix}")
+    if not os.path.exists(recognizer_path):
+        export(ImageOnly(reader.recognizer), torch.randn(2, 1, 64, 256), recognizer_path, ['prediction'], {
+            'image': {0: 'batch', 3: 'width'},
+            'prediction': {0: 'batch', 1: 'length'},
+        })
+
+    reader.detector = OnnxModel(detector_path)
+    reader.recognizer = OnnxModel(recognizer_path)
+    return reader
+
+
+def check_parity(images: list, langs: tuple) -> list[tuple]:
+    """ Reads every image with both backends. Returns (image, torch text, onnx text) for the images they disagree on. """
+    import easyocr
+    torch_reader = easyocr.Reader(list(langs), gpu=False, quantize=onnx_quantize)
+    onnx_reader = convert_reader(easyocr.Reader(list(langs), gpu=False, quantize=False), langs)
+
+    mismatches = []
+    for image in images:
+        torch_text = [result[1] for result in torch_reader.readtext(image)]
+        onnx_text = [result[1] for result in onnx_reader.readtext(image)]
+        if torch_text != onnx_text:
+            mismatches.append((image, torch_text, onnx_text))
+
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks the onnx backend reads the same text as torch easyocr')
+    parser.add_argument('images', nargs='+', help='Image files to read')
+    parser.add_argument('-l', '--langs', nargs='+', default=['en'], help='easyocr language codes, e.g de en')
+    args = parser.parse_args()
+
+    results = check_parity(args.images, tuple(args.langs))
+    for fp, torch_text, onnx_text in results:
+        print(f'{fp}\n  torch: {torch_text}\n  onnx:  {onnx_text}')
+    print(f'{len(args.images) - len(results)}/{len(args.images)} images read the same')
@@ -0,0 +1,140 @@
+""" OCRAutoModerator OCR preprocessing
+@authors:
+---
+https://github.com/theimperious1
+https://www.reddit.com/user/theimperious1
+"""
+
+import logging
+import numpy as np
+from OCRAutoModerator.config.config import ocr_grayscale, ocr_target_text_height, ocr_min_text_height, ocr_max_side, \
+    ocr_tile_size, ocr_tile_overlap
+
+logger = logging.getLogger(__name__)
+
+# Side length images are shrunk to before their text is measured
+MEASURE_SIDE = 1024
+# Fewer glyphs than this and the measured text height is too unreliable to scale by
+MIN_GLYPHS = 8
+# More blobs than this and an image is assumed to have text rather than comparing every pair of them
+MAX_SCORED_GLYPHS = 1500
+
+
+def preprocess(image: np.ndarray, scale: float = None) -> list[np.ndarray]:
+    """
+    Prepares a decoded RGB image or frame for OCR. Blocking.
+    The image is converted to greyscale and scaled down until its text is about ocr_target_text_height pixels tall,
+    which is all either engine needs, but never so far that its smallest text drops below ocr_min_text_height.
+    Images are never scaled up. Anything still larger than ocr_tile_size, e.g a long screenshot, is cut into overlapping
+    tiles that are read in parallel.
+    scale overrides the measured one, e.g the one shared by every frame of a video, see get_frames_scale.
+    """
+    import cv2
+    if ocr_grayscale and image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+    if scale is None:
+        scale = get_scale(image)
+    if scale < 1:
+        height, width = image.shape[:2]
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    return get_tiles(image)
+
+
+def get_scale(image: np.ndarray) -> float:
+    """ How much an image can be shrunk by, going by the height of its text """
+    heights = get_glyph_heights(image)
+    if len(heights) < MIN_GLYPHS:
+        # No text to measure, so just cap its size
+        return min(1.0, ocr_max_side / max(image.shape[:2]))
+
+    typical, smallest = np.percentile(heights, (25, 5))
+    return min(1.0, max(ocr_target_text_height / typical, ocr_min_text_height / smallest))
+
+
+def get_frames_scale(frames: list) -> float:
+    """ One scale for every frame of a video or gif, the median of their own. Scaled alike, same-sized frames come
+    out the same size, so easyocr can still batch them, see OCRBatcher. """
+    return float(np.median([get_scale(frame) for frame in frames]))
+
+
+def get_glyph_heights(image: np.ndarray) -> np.ndarray:
+    """ Heights in pixels of the blobs in an image shaped like letters """
+    return get_glyph_boxes(image)[:, 3]
+
+
+def get_glyph_boxes(image: np.ndarray) -> np.ndarray:
+    """
+    (x, y, width, height) boxes in pixels of the blobs in an image shaped like letters, found on a copy shrunk to
+    MEASURE_SIDE. Both dark text on a light background and light text on a dark one, e.g meme captions, are looked for.
+    """
+    import cv2
+    grey = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    factor = min(1.0, MEASURE_SIDE / max(grey.shape[:2]))
+    if factor < 1:
+        grey = cv2.resize(grey, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+
+    boxes = []
+    max_height = grey.shape[0] * 0.2
+    for polarity in (cv2.THRESH_BINARY_INV, cv2.THRESH_BINARY):
+        binary = cv2.adaptiveThreshold(grey, 255, cv2.ADAPTIVE_THRESH_MEAN_C, polarity, 31, 15)
+        _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+        width, height, area = stats[1:, cv2.CC_STAT_WIDTH], stats[1:, cv2.CC_STAT_HEIGHT], stats[1:, cv2.CC_STAT_AREA]
+        glyphs = (height >= 4) & (height <= max_height) & (width <= height * 2) & (width * 10 >= height) & \
+                 (area * 6 >= width * height)
+        boxes.append(stats[1:, :4][glyphs])
+
+    return np.concatenate(boxes) / factor
+
+
+def get_text_score(image: np.ndarray) -> int:
+    """
+    How likely an image or tile is to contain text, as the number of its letter shaped blobs that sit next to another
+    one of about the same height on the same line, like letters in a word. Photos have plenty of blobs, but few of
+    them line up like that. Images with more than MAX_SCORED_GLYPHS blobs aren't scored and count as having text.
+    """
+    boxes = get_glyph_boxes(image)
+    if len(boxes) > MAX_SCORED_GLYPHS:
+        return len(boxes)
+
+    x, y, width, height = boxes.T
+    center = y + height / 2
+    ratio = height[:, None] / height[None, :]
+    gap = np.maximum(x[:, None], x[None, :]) - np.minimum(x + width, (x + width)[:, None])
+    neighbours = (ratio > 0.7) & (ratio < 1.4) & \
+                 (np.abs(center[:, None] - center[None, :]) < height[:, None] / 2) & \
+                 (gap < height[:, None] * 1.5)
+    np.fill_diagonal(neighbours, False)
+    return int(neighbours.any(axis=1).sum())
+
+
+def get_text_scores(images: list) -> list[int]:
+    """ Blocking """
+    return [get_text_score(image) for image in images]
+
+
+def get_tiles(image: np.ndarray) -> list[np.ndarray]:
+    """ Cuts an image into ocr_tile_size tiles overlapping by ocr_tile_overlap, so a line of text cut in two by one
+    tile's edge is still whole in the next. Every tile is the same size, so easyocr can batch them. """
+    height, width = image.shape[:2]
+    if max(height, width) <= ocr_tile_size:
+        return [image]
+
+    tiles = [
+        image[top:top + ocr_tile_size, left:left + ocr_tile_size]
+        for top in get_tile_starts(height) for left in get_tile_starts(width)
+    ]
+    logger.debug(f'Cut a {width}x{height} image into {len(tiles)} tiles')
+    return tiles
+
+
+def get_tile_starts(length: int) -> list[int]:
+    if length <= ocr_tile_size:
+        return [0]
+    stride = ocr_tile_size - ocr_tile_overlap
+    starts = list(range(0, length - ocr_tile_size, stride))
+    # The last tile is lined up with the far edge rather than running past it
+    starts.append(length - ocr_tile_size)
+    return starts
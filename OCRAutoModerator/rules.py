@@ -0,0 +1,164 @@
+""" OCRAutoModerator compiled rules
+@authors:
+---
+https://github.com/theimperious1
+https://www.reddit.com/user/theimperious1
+"""
+
+import operator
+from OCRAutoModerator.config.config import default_ocr_engine
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+# OCR engine modes a rule can ask for, cheapest first. See get_engine_mode
+ENGINE_MODES = ('fast', 'thorough', 'both')
+
+# Same month/year lengths as utils.get_time_difference
+TIME_UNITS = {
+    'minutes': 60,
+    'hours': 60 * 60,
+    'days': 60 * 60 * 24,
+    'weeks': 60 * 60 * 24 * 7,
+    'months': 60 * 60 * 24 * 7 * 4,
+    'years': 60 * 60 * 24 * 7 * 4 * 12,
+}
+
+# How expensive each fact is to look up, conditions are checked cheapest first.
+# 0: already on the submission. 1: one lazy fetch of the author. 2: one extra API call. 3: paged listings.
+FACT_COSTS = {
+    'locked': 0,
+    'is_original_content': 0,
+    'is_self': 0,
+    'over_18': 0,
+    'link_flair_text': 0,
+    'link_flair_css_class': 0,
+    'link_flair_template_id': 0,
+    'num_comments': 0,
+    'link_karma': 1,
+    'comment_karma': 1,
+    'account_age': 1,
+    'created_utc': 1,
+    'has_verified_email': 1,
+    'is_mod': 1,
+    'is_gold': 1,
+    'is_suspended': 1,
+    'profile_over_18': 1,
+    'followers': 1,
+    'description': 1,
+    'trophies': 2,
+    'mod_notes': 2,
+    'comments': 3,
+    'submissions': 3,
+}
+
+# rule_set key -> submission fact
+_SUBMISSION_EQUALS = {
+    'is_locked': 'locked',
+    'is_original_content': 'is_original_content',
+    'is_self': 'is_self',
+    'is_nsfw': 'over_18',
+    'flair_text': 'link_flair_text',
+    'flair_css_class': 'link_flair_css_class',
+    'flair_template_id': 'link_flair_template_id',
+}
+
+# author key -> author fact
+_AUTHOR_EQUALS = {
+    'has_verified_email': 'has_verified_email',
+    'is_mod': 'is_mod',
+    'is_gold': 'is_gold',
+    'is_suspended': 'is_suspended',
+    'is_nsfw': 'profile_over_18',
+}
+
+_AUTHOR_OPERATORS = {
+    'post_karma': 'link_karma',
+    'comment_karma': 'comment_karma',
+    'has_followers': 'followers',
+    'has_trophies': 'trophies',
+    'has_submissions': 'submissions',
+    'has_comments': 'comments',
+}
+
+
+class Condition:
+    """ One check of a fact about a submission or its author, e.g link_karma >= 100 """
+    __slots__ = ('fact', 'operator', 'value', 'satisfy_any')
+
+    def __init__(self, fact: str, operator_name: str, value, satisfy_any: bool = True):
+        self.fact = fact
+        self.operator = operator_name
+        self.value = value
+        self.satisfy_any = satisfy_any
+
+    def test(self, fact_value) -> bool:
+        if self.operator == '==':
+            return fact_value == self.value
+
+        if self.operator == 'contains':
+            # fact_value is a list of texts, e.g mod notes
+            values = [self.value] if type(self.value) is str else self.value
+            found = [any(value in text for text in fact_value) for value in values]
+            return any(found) if self.satisfy_any else all(found)
+
+        return OPERATORS[self.operator](fact_value, self.value)
+
+
+class CompiledRule:
+    """ A validated rule_set, with its conditions sorted cheapest first """
+    __slots__ = ('index', 'rule_set', 'action', 'action_reason', 'priority', 'enabled', 'decisive', 'engine',
+                 'conditions', 'links')
+
+    def __init__(self, index: int, rule_set: dict):
+        self.index = index
+        self.rule_set = rule_set
+        self.action = rule_set['action'].strip()
+        self.action_reason = rule_set['action_reason']
+        self.priority = rule_set['priority']
+        self.enabled = rule_set['type'].strip() in ('any', 'image') and self.action != 'nothing'
+        # A match on a decisive rule settles the submission, so OCR of its remaining frames can be cancelled
+        self.decisive = self.action in ('remove', 'spam') and rule_set.get('stop_on_match', True)
+        self.engine = rule_set.get('engine', default_ocr_engine)
+
+        conditions = []
+        for key, fact in _SUBMISSION_EQUALS.items():
+            if key in rule_set:
+                conditions.append(Condition(fact, '==', rule_set[key]))
+
+        if 'has_comments' in rule_set:
+            conditions.append(Condition('num_comments', *rule_set['has_comments']))
+
+        author = rule_set.get('author', {})
+        for key, fact in _AUTHOR_EQUALS.items():
+            if key in author:
+                conditions.append(Condition(fact, '==', author[key]))
+
+        for key, fact in _AUTHOR_OPERATORS.items():
+            if key in author:
+                conditions.append(Condition(fact, *author[key][:2]))
+
+        if 'account_age' in author:
+            operator_set = author['account_age']
+            unit = operator_set[2] if len(operator_set) > 2 else 'days'
+            conditions.append(Condition('account_age', operator_set[0], operator_set[1] * TIME_UNITS[unit]))
+
+        if 'mod_notes' in author:
+            mod_notes = author['mod_notes']
+            conditions.append(Condition('mod_notes', 'contains', mod_notes['contains'],
+                                        mod_notes.get('satisfy_any_threshold', True)))
+
+        if 'description_contains' in author:
+            conditions.append(Condition('description', 'contains', author['description_contains']))
+
+        self.conditions = sorted(conditions, key=lambda condition: FACT_COSTS[condition.fact])
+        self.links = author.get('links')
+
+
+def get_engine_mode(rules: list) -> str:
+    """ A submission's text is shared by all of its rules, so it's read as thoroughly as the most demanding rule asks """
+    return max((rule.engine for rule in rules), key=ENGINE_MODES.index, default=default_ocr_engine)
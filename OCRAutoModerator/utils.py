@@ -5,9 +5,15 @@ https://github.com/theimperious1
 https://www.reddit.com/user/theimperious1
 """
 
+import asyncio
 import logging
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from io import BytesIO
+import numpy as np
 from praw.models import Subreddit, Redditor, Submission
 import requests
 from OCRAutoModerator.data_types import MatchSets
@@ -19,6 +25,9 @@ logger = logging.getLogger(__name__)
 
 allowed_video_formats = ['.gif', 'gifv', '.mp4']
 
+# praw's session and rate limiter aren't thread safe, so every praw call is made in this one thread, see run_praw
+reddit_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='praw')
+
 
 # noinspection PyBroadException
 def fetch_media(img_url: str):
@@ -46,6 +55,29 @@ def fetch_media(img_url: str):
         return False
 
 
+async def run_praw(function, *args, **kwargs):
+    """ Runs a blocking praw call, or anything that makes them, in reddit_executor rather than on the event loop """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(reddit_executor, partial(function, *args, **kwargs))
+
+
+@contextmanager
+def time_phase(timings: dict, phase: str):
+    """ Records how many seconds the with block took in timings[phase] """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = time.perf_counter() - start
+
+
+def image_to_array(image: Image.Image) -> np.ndarray:
+    """ Decodes a fetched image once into an RGB array that every OCR engine and language pass can share """
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return np.asarray(image)
+
+
 def is_video_or_gif(submission: Submission = None, url: str = None):
     if submission is None and url is None:
         raise TypeError('You must provide at least one non-None parameter!')
@@ -68,7 +100,7 @@ async def is_user_mod(subreddit: Subreddit, author: Redditor):
     """ Checks if user is a moderator of a subreddit we are """
     if author in developers:
         return True
-    for moderator in subreddit.moderator():
+    for moderator in await run_praw(subreddit.moderator):
         if author == moderator.name:
             return True
     return False
@@ -8,26 +8,39 @@ https://www.reddit.com/user/nickofolas
 
 cv2_comparison off stackoverflow, modified by theimperious1
 """
+import numpy as np
 from PIL import Image
 
+# diff_hash walks the 8x8 thumbnail in a snake, left to right on even rows and right to left on odd rows,
+# comparing every pixel with the one before it. The first pixel is compared with the bottom left pixel.
+_SNAKE_ORDER = np.array([row * 8 + (col if row % 2 == 0 else 7 - col) for row in range(8) for col in range(8)])
+_PREV_ORDER = np.concatenate(([7 * 8], _SNAKE_ORDER[:-1]))
+
+# Number of set bits in every possible byte, used to popcount uint64 arrays
+_POPCOUNT_8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
 
 def diff_hash(image):
     """Generates a difference hash from an image"""
-    img = image.convert("L")
-    img = img.resize((8, 8), Image.ANTIALIAS)
-    prev_px = img.getpixel((0, 7))
-    hash_diff = 0
-    for row in range(0, 8, 2):
-        for col in range(8):
-            hash_diff <<= 1
-            pixel = img.getpixel((col, row))
-            hash_diff |= 1 * (pixel >= prev_px)
-            prev_px = pixel
-        row += 1
-        for col in range(7, -1, -1):
-            hash_diff <<= 1
-            pixel = img.getpixel((col, row))
-            hash_diff |= 1 * (pixel >= prev_px)
-            prev_px = pixel
-    img.close()
-    return hash_diff
+    return int(diff_hash_batch([image])[0])
+
+
+def diff_hash_batch(images) -> np.ndarray:
+    """Generates the difference hash of every image or frame (PIL images or arrays) in one call.
+    Returns a uint64 array with the same values diff_hash gives for each image."""
+    thumbnails = np.empty((len(images), 64), dtype=np.uint8)
+    for i, image in enumerate(images):
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        img = image.convert("L")
+        thumbnails[i] = np.asarray(img.resize((8, 8), Image.LANCZOS)).reshape(64)
+        img.close()
+
+    bits = thumbnails[:, _SNAKE_ORDER] >= thumbnails[:, _PREV_ORDER]
+    return np.ascontiguousarray(np.packbits(bits, axis=1)).view('>u8').reshape(-1).astype(np.uint64)
+
+
+def hamming_distance(hashes: np.ndarray, other: int) -> np.ndarray:
+    """Number of differing bits between every hash in a uint64 array and another hash"""
+    xor = np.bitwise_xor(hashes.astype(np.uint64), np.uint64(other))
+    return _POPCOUNT_8[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
@@ -0,0 +1,61 @@
+""" OCRAutoModerator video frame sampling tests
+@authors:
+---
+https://github.com/theimperious1
+https://www.reddit.com/user/theimperious1
+
+Writes short videos of a still picture, and checks that get_video_frames takes a new frame when a caption appears over
+it partway through, but not while nothing changes. Skipped when opencv or imageio-ffmpeg aren't available.
+"""
+
+import numpy as np
+import pytest
+
+FPS = 10
+SECONDS = 4
+SIZE = (320, 240)
+
+
+@pytest.fixture(scope='module')
+def media_manager():
+    pytest.importorskip('imageio_ffmpeg')
+    pytest.importorskip('cv2')
+    # Needs a config.py, as the bot does
+    return pytest.importorskip('OCRAutoModerator.managers.content_managers.media_manager')
+
+
+def get_background() -> np.ndarray:
+    """ A smooth gradient, like a photo's sky, rather than a flat colour """
+    width, height = SIZE
+    row = np.linspace(40, 200, width, dtype=np.uint8)
+    return np.repeat(np.stack([row, row[::-1], np.full(width, 120, np.uint8)], axis=1)[None], height, axis=0)
+
+
+def write_video(fp: str, caption_from: float = None) -> None:
+    """ Writes the background for SECONDS, with a caption on it from caption_from seconds on """
+    import cv2
+    writer = cv2.VideoWriter(fp, cv2.VideoWriter_fourcc(*'mp4v'), FPS, SIZE)
+    assert writer.isOpened()
+    for i in range(FPS * SECONDS):
+        frame = get_background()
+        if caption_from is not None and i >= caption_from * FPS:
+            cv2.putText(frame, 'FOLLOW ME', (20, 210), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+        writer.write(frame)
+    writer.release()
+
+
+def test_static_video_is_taken_once(media_manager, tmp_path):
+    fp = str(tmp_path / 'static.mp4')
+    write_video(fp)
+    assert len(media_manager.get_video_frames(fp)) == 1
+
+
+def test_caption_over_static_video_is_taken(media_manager, tmp_path):
+    fp = str(tmp_path / 'caption.mp4')
+    write_video(fp, caption_from=SECONDS / 2)
+    frames = media_manager.get_video_frames(fp)
+
+    assert len(frames) == 2
+    # The caption is in the bottom rows, and only the second frame has it
+    first, second = (frame[190:220].astype(np.int16) for frame in frames)
+    assert np.abs(second - first).max() > 100
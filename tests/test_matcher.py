@@ -0,0 +1,44 @@
+""" OCRAutoModerator rule matching tests
+@authors:
+---
+https://github.com/theimperious1
+https://www.reddit.com/user/theimperious1
+
+Checks that every item of a rule_set is reported when several of them match the same text, including items that
+overlap or start with another item.
+"""
+
+import pytest
+from OCRAutoModerator.matcher import RuleMatcher
+
+
+@pytest.fixture(scope='module')
+def compile_rule_patterns():
+    # Needs a config.py, as the bot does
+    return pytest.importorskip('OCRAutoModerator.managers.wiki_manager').compile_rule_patterns
+
+
+def get_matches(compile_rule_patterns, items: list, modifiers: tuple, text: str) -> dict:
+    config = [{'rule': items, 'rule_modifiers': list(modifiers)}]
+    return RuleMatcher(config, {0: compile_rule_patterns(tuple(items), modifiers)}).search(text)
+
+
+def test_overlapping_regex_items_all_match(compile_rule_patterns):
+    matches = get_matches(compile_rule_patterns, ['only\\s*fans', 'fans\\s*link'], ('regex',),
+                          'Check my onlyfans link in bio')
+    assert matches == {0: ['only\\s*fans', 'fans\\s*link']}
+
+
+def test_regex_item_starting_with_another_matches(compile_rule_patterns):
+    matches = get_matches(compile_rule_patterns, ['free', 'free\\s+money'], ('regex',), 'FREE MONEY here')
+    assert matches == {0: ['free', 'free\\s+money']}
+
+
+def test_plain_items_sharing_a_prefix_all_match(compile_rule_patterns):
+    matches = get_matches(compile_rule_patterns, ['free', 'free money'], ('includes-word',), 'get free money now')
+    assert matches == {0: ['free', 'free money']}
+
+
+def test_automaton_reports_overlapping_items():
+    config = [{'rule': ['only', 'onlyfans', 'fans']}]
+    assert RuleMatcher(config, {}).search('OnlyFans') == {0: ['only', 'onlyfans', 'fans']}
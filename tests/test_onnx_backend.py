@@ -0,0 +1,42 @@
+""" OCRAutoModerator ONNX Runtime backend tests
+@authors:
+---
+https://github.com/theimperious1
+https://www.reddit.com/user/theimperious1
+
+Reads the fixed images in data/onnx_parity with torch easyocr and with the exported ONNX models, and checks they read
+the same text. Skipped when onnxruntime, easyocr or its English models aren't available.
+"""
+
+import os
+import pytest
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'data', 'onnx_parity')
+CORPUS = sorted(os.path.join(CORPUS_DIR, name) for name in os.listdir(CORPUS_DIR) if name.endswith('.png'))
+
+
+@pytest.fixture(scope='module')
+def onnx_backend(tmp_path_factory):
+    pytest.importorskip('onnxruntime')
+    pytest.importorskip('onnx')
+    easyocr = pytest.importorskip('easyocr')
+    # Needs a config.py, as the bot does
+    backend = pytest.importorskip('OCRAutoModerator.onnx_backend')
+
+    try:
+        easyocr.Reader(['en'], gpu=False, download_enabled=False, verbose=False)
+    except Exception as e:
+        pytest.skip(f"easyocr's English models aren't downloaded: {e}")
+
+    backend.onnx_model_dir = str(tmp_path_factory.mktemp('onnx_models'))
+    return backend
+
+
+def test_corpus_is_present():
+    assert len(CORPUS) >= 5
+
+
+def test_onnx_reads_same_text_as_torch(onnx_backend):
+    mismatches = onnx_backend.check_parity(CORPUS, ('en',))
+    assert not mismatches, '\n'.join(f'{os.path.basename(fp)}: torch {torch_text} != onnx {onnx_text}'
+                                     for fp, torch_text, onnx_text in mismatches)